@@ -24,7 +24,6 @@ import json
 import matplotlib.pyplot as plt
 from sklearn.metrics import pairwise_distances
 from sklearn.manifold import MDS
-import copy
 import torch
 from sklearn.linear_model import LogisticRegression
 from scipy.io import loadmat
@@ -32,7 +31,6 @@ import random
 
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader
 import matplotlib.colors as mplcol
 
 import time
@@ -367,7 +365,7 @@ def model_behaviour_vs_theory(args, device):
         args.model_id = get_id_from_name(m)
         testParams = setup_test_parameters(args, device)
         ttsplit_text = '_blockingttsplit' if args.block_int_ttsplit else ''
-        basefilename = const.LESIONS_DIRECTORY + 'lesiontests'+m[:-4] + ttsplit_text
+        basefilename = os.path.join(const.LESIONS_DIRECTORY, 'lesiontests'+m[:-4] + ttsplit_text)
 
         # perform or load the lesion tests
         lesiondata, regulartestdata = perform_lesion_tests(args, testParams, basefilename)
@@ -408,11 +406,15 @@ def average_perf_across_models(args):
                     if (args.train_long and 'long' in training_record) or (not args.train_long and 'short' in training_record):
                         print('Found matching model: id{}'.format(args.model_id))
                         # we've found the training record for a model we care about
-                        with open(os.path.join(const.TRAININGRECORDS_DIRECTORY, training_record)) as record_file:
-                            record = json.load(record_file)
-                            train_performance.append(record["trainingPerformance"])
-                            test_performance.append(record["testPerformance"])
-                            record_name = training_record[:-5]
+                        record_path = os.path.join(const.TRAININGRECORDS_DIRECTORY, training_record)
+                        if training_record.endswith('.npz'):
+                            record = np.load(record_path)
+                        else:  # training records saved before they were written as .npz
+                            with open(record_path) as record_file:
+                                record = json.load(record_file)
+                        train_performance.append(record["trainingPerformance"])
+                        test_performance.append(record["testPerformance"])
+                        record_name = os.path.splitext(training_record)[0]
 
     train_performance = np.asarray(train_performance)
     test_performance = np.asarray(test_performance)
@@ -501,7 +503,7 @@ def get_paired_test_model_id(args):
     (e.g. blocked) and test it under the dataset from the other (e.g. interleaved).
     This function will return the test set paired with the training args listed in args.
     """
-    original_blocking = copy.deepcopy(args.all_fullrange)
+    original_blocking = args.all_fullrange
     args.all_fullrange = False # blocked
     all_blocked_datasets = get_model_names(args)
 
@@ -554,11 +556,11 @@ def setup_test_parameters(args, device):
 
     print('model: {}'.format(trained_modelname))
     print('test set: {}'.format(datasetname))
-    testloader = DataLoader(testset, batch_size=args.test_batch_size, shuffle=False)
+    testloader = dset.get_loader(testset, args.test_batch_size, device, num_workers=args.loader_workers)
 
     # load our trained model
-    trained_model = torch.load(trained_modelname)
-    criterion = nn.BCELoss() #nn.CrossEntropyLoss()   # binary cross entropy loss
+    trained_model = torch.load(trained_modelname, map_location=device)
+    criterion = nn.BCEWithLogitsLoss() #nn.CrossEntropyLoss()   # binary cross entropy loss on the output logits
     printOutput = True
     testParams = [args, trained_model, device, testloader, criterion, printOutput]
     return testParams
@@ -585,7 +587,7 @@ def analyse_network(args):
 
     if not preanalysed:
         # load the trained model and the datasets it was trained/tested on
-        trained_model = torch.load(trained_modelname)
+        trained_model = torch.load(trained_modelname, map_location='cpu')   # the activations are read on the cpu
         trainset, testset, crossvalset, np_trainset, np_testset, np_crossvalset = dset.load_input_data(const.DATASET_DIRECTORY, datasetname)
 
         if args.block_int_ttsplit:
@@ -608,10 +610,11 @@ def analyse_network(args):
         for set in setnames:
 
             # Assess the network activations on either the regular test set or the cross-validation set
+            # (worker processes prepare the next sequences while the network runs on the current one)
             if set=='test':
-                test_loader = DataLoader(testset, batch_size=1, shuffle=False)
+                test_loader = dset.get_loader(testset, 1, 'cpu', num_workers=args.loader_workers)
             elif set =='crossval':
-                test_loader = DataLoader(crossvalset, batch_size=1, shuffle=False)
+                test_loader = dset.get_loader(crossvalset, 1, 'cpu', num_workers=args.loader_workers)
 
             for whichTrialType in ['compare']: #['compare', 'fillers']:
                 activations, MDSlabels, labels_refValues, labels_judgeValues, labels_contexts, time_index, counter, drift, temporal_trialtypes = mnet.get_activations(args, np_testset, trained_model, test_loader, whichTrialType) # SN could be a problem here (loads testset)
@@ -652,8 +655,8 @@ def analyse_network(args):
                     MDS_dict["filler_dict"] = dict
 
             # save our activation RDMs for easy access
-            np.save(const.RDM_DIRECTORY + 'RDM_'+set+'_compare_'+analysis_name[29:]+'.npy', MDS_dict["sl_activations"])  # the RDM matrix only
-            #np.save(const.RDM_DIRECTORY + 'RDM_'+set+'_fillers_'+analysis_name[29:]+'.npy', MDS_dict["filler_dict"]["sl_activations"])  # the RDM matrix only
+            np.save(const.RDM_DIRECTORY / ('RDM_'+set+'_compare_'+analysis_name[29:]+'.npy'), MDS_dict["sl_activations"])  # the RDM matrix only
+            #np.save(const.RDM_DIRECTORY / ('RDM_'+set+'_fillers_'+analysis_name[29:]+'.npy'), MDS_dict["filler_dict"]["sl_activations"])  # the RDM matrix only
             if set=='test':
                 MDS_dict['testset_assessment'] = MDS_dict
             elif set=='crossval':
@@ -1094,10 +1097,10 @@ def plot_postlesion(args, retrain_args, model_list):
         testParams = setup_test_parameters(args, device)
         datasetname = const.RETRAINING_DATASET
         trainset, testset, _, _, _, _ = dset.load_input_data(const.DATASET_DIRECTORY, datasetname)
-        testloader = DataLoader(testset, batch_size=args.test_batch_size, shuffle=False)
+        testloader = dset.get_loader(testset, args.test_batch_size, testParams[2], num_workers=args.loader_workers)
 
         testParams[3] = testloader
-        basefilename = const.LESIONS_DIRECTORY + 'lesiontests'+retrained_modelname[7:-4]
+        basefilename = os.path.join(const.LESIONS_DIRECTORY, 'lesiontests'+retrained_modelname[7:-4])
         filename = basefilename+'.npy'
         print(filename)
 
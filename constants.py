@@ -9,74 +9,141 @@ Sheahan, H.*, Luyckx, F.*, Nelli, S., Taupe, C., & Summerfield, C. (2021). Neura
  Date: 13/03/2020
 """
 
-import numpy as np
-
-# Save/load directories
-DATASET_DIRECTORY = 'datasets/'
-MODEL_DIRECTORY = 'models/'
-FIGURE_DIRECTORY = 'figures/'
-ANIMATION_DIRECTORY = 'animations/'
-TRAININGRECORDS_DIRECTORY = 'trainingrecords/'
-TB_LOG_DIRECTORY = 'results/runs/'                        # tensorboard records
-NETANALYIS_DIRECTORY = 'network_analysis/'
-LESIONS_DIRECTORY = 'network_analysis/lesion_tests/'
-RDM_DIRECTORY = 'network_analysis/RDMs/'
-PARAMETER_DIRECTORY = 'linesmodel_parameters/'
-EEG_DIRECTORY = 'datasets/'
-TRIALS_DIRECTORY = 'trials/'
+from enum import IntEnum
+from pathlib import Path
+from typing import Final
+
+# Save/load directories (build file paths with '/' or os.path.join, not string concatenation)
+DATASET_DIRECTORY: Final[Path] = Path('datasets')
+MODEL_DIRECTORY: Final[Path] = Path('models')
+FIGURE_DIRECTORY: Final[Path] = Path('figures')
+ANIMATION_DIRECTORY: Final[Path] = Path('animations')
+TRAININGRECORDS_DIRECTORY: Final[Path] = Path('trainingrecords')
+TB_LOG_DIRECTORY: Final[Path] = Path('results/runs')                        # tensorboard records
+NETANALYIS_DIRECTORY: Final[Path] = Path('network_analysis')
+LESIONS_DIRECTORY: Final[Path] = NETANALYIS_DIRECTORY / 'lesion_tests'
+RDM_DIRECTORY: Final[Path] = NETANALYIS_DIRECTORY / 'RDMs'
+PARAMETER_DIRECTORY: Final[Path] = Path('linesmodel_parameters')
+EEG_DIRECTORY: Final[Path] = DATASET_DIRECTORY
+TRIALS_DIRECTORY: Final[Path] = Path('trials')
 
 # Total maximum numbers for one-hot coding
-TOTALMAXNUM = 8    # max numerosity
-NCONTEXTS = 2       # max number of contexts for one-hot coding
-NTYPEBITS = 1       # just need one input bit to flag whether current trial is 'compare' or 'filler'
+TOTALMAXNUM: Final[int] = 8    # max numerosity
+NCONTEXTS: Final[int] = 2       # max number of contexts for one-hot coding
+NTYPEBITS: Final[int] = 1       # just need one input bit to flag whether current trial is 'compare' or 'filler'
+# ONEHOT_NUM and ONEHOT_CONTEXT (read-only one-hot bases) are numpy-backed; see the end of this file
 
 
 # define upper and lower limits for each # range)
-FULLR_LLIM = 1      # full # range, lower limit
-FULLR_ULIM = 8     # full # range, upper limit
-LOWR_LLIM = 1       # low # range, lower limit
-LOWR_ULIM = 4      # low # range, upper limit
-HIGHR_LLIM = 5      # high # range, lower limit
-HIGHR_ULIM = 8     # high # range, upper limit
+FULLR_LLIM: Final[int] = 1      # full # range, lower limit
+FULLR_ULIM: Final[int] = 8     # full # range, upper limit
+LOWR_LLIM: Final[int] = 1       # low # range, lower limit
+LOWR_ULIM: Final[int] = 4      # low # range, upper limit
+HIGHR_LLIM: Final[int] = 5      # high # range, lower limit
+HIGHR_ULIM: Final[int] = 8     # high # range, upper limit
 
 # the resulting range spans
-FULLR_SPAN = FULLR_ULIM - FULLR_LLIM +1
-LOWR_SPAN = LOWR_ULIM - LOWR_LLIM +1
-HIGHR_SPAN = HIGHR_ULIM - HIGHR_LLIM +1
+FULLR_SPAN: Final[int] = 8     # = FULLR_ULIM - FULLR_LLIM + 1
+LOWR_SPAN: Final[int] = 4      # = LOWR_ULIM - LOWR_LLIM + 1
+HIGHR_SPAN: Final[int] = 4     # = HIGHR_ULIM - HIGHR_LLIM + 1
+if __debug__:  # keep the literal spans in step with the range limits above
+    assert FULLR_SPAN == FULLR_ULIM - FULLR_LLIM + 1
+    assert LOWR_SPAN == LOWR_ULIM - LOWR_LLIM + 1
+    assert HIGHR_SPAN == HIGHR_ULIM - HIGHR_LLIM + 1
 
 # trial types
-TRIAL_FILLER  = 0
-TRIAL_COMPARE = 1
+class TrialType(IntEnum):
+    FILLER = 0
+    COMPARE = 1
+
+TRIAL_FILLER: Final[TrialType]  = TrialType.FILLER
+TRIAL_COMPARE: Final[TrialType] = TrialType.COMPARE
+TRIAL_TYPE_DTYPE: Final[str] = 'int8'   # numpy dtype for trial type arrays (0/1 codes fit in a single byte)
 
 # the same as the spans... but used in lines_model
-N_POINTS_LONG = 8
-N_POINTS_SHORT = 4
+N_POINTS_LONG: Final[int] = FULLR_SPAN
+N_POINTS_SHORT: Final[int] = LOWR_SPAN
 
 # mean values for each context
 # ! not for us; have to adjust for our contexts
-CONTEXT_FULL_MEAN = np.mean(range(FULLR_LLIM, FULLR_ULIM+1))  # 8.5
-CONTEXT_LOW_MEAN = np.mean(range(LOWR_LLIM, LOWR_ULIM+1))     # 6
-CONTEXT_HIGH_MEAN = np.mean(range(HIGHR_LLIM, HIGHR_ULIM+1))  # 11
-GLOBAL_MEAN = 4.5 #np.mean([list(range(FULLR_LLIM, FULLR_ULIM+1)), list(range(LOWR_LLIM, LOWR_ULIM+1)), list(range(HIGHR_LLIM, HIGHR_ULIM+1))])
+CONTEXT_FULL_MEAN: Final[float] = (FULLR_LLIM + FULLR_ULIM) / 2  # 4.5
+CONTEXT_LOW_MEAN: Final[float] = (LOWR_LLIM + LOWR_ULIM) / 2     # 2.5
+CONTEXT_HIGH_MEAN: Final[float] = (HIGHR_LLIM + HIGHR_ULIM) / 2  # 6.5
+GLOBAL_MEAN: Final[float] = 4.5 #np.mean([list(range(FULLR_LLIM, FULLR_ULIM+1)), list(range(LOWR_LLIM, LOWR_ULIM+1)), list(range(HIGHR_LLIM, HIGHR_ULIM+1))])
 
 # Figure colours
-CONTEXT_COLOURS = ['dodgerblue', 'orangered', 'gold', 'black']  # low, high, full
-MODEL_COLOURS = ['darkkhaki', 'olivedrab','darkolivegreen']  # change to show both local and global on same plot easily and keep main colours for data
+CONTEXT_COLOURS: Final[tuple[str, ...]] = ('dodgerblue', 'orangered', 'gold', 'black')  # low, high, full
+MODEL_COLOURS: Final[tuple[str, ...]] = ('darkkhaki', 'olivedrab','darkolivegreen')  # change to show both local and global on same plot easily and keep main colours for data
+
+# Dataset array layout: every field is stored as (sequences, BPTT_len) + the per-trial feature shape below
+INPUT_WIDTH: Final[int] = TOTALMAXNUM + NCONTEXTS + NTYPEBITS  # width of the recurrent input: number one-hot, context one-hot, trial type bit
+INPUT_DTYPE: Final[str] = 'float32'
+DIGITS_DTYPE: Final[str] = 'int8'   # numpy dtype for the integer number/context fields (all values fit in a single byte)
+DATASET_SHAPES: Final[dict[str, tuple[int, ...]]] = {
+    'input': (TOTALMAXNUM,),
+    'refValue': (TOTALMAXNUM,),
+    'judgementValue': (TOTALMAXNUM,),
+    'label': (),
+    'context': (NCONTEXTS,),
+    'contextdigits': (),
+    'judgementdigits': (),
+    'refdigits': (),
+    'contextinputs': (NCONTEXTS,),
+    'trialtypeinputs': (),
+}
 
 # Single dataset for retraining decoders under blocked, VI conditions
-RETRAINING_DATASET = 'dataset_truecontextlabel_numrangeblocked_bpl120_id9999'#'dataset_truecontextlabel_numrangeblocked_bpl120_id9999'
+RETRAINING_DATASET: Final[str] = 'dataset_truecontextlabel_numrangeblocked_bpl120_id9999'#'dataset_truecontextlabel_numrangeblocked_bpl120_id9999'
 
 # Making some more constants found thoughout the code
 # define dataset
-MTESTSETS = 2     # have multiple test sets for cross-validation of activations
-NTRAIN = 2880       # how many examples we want to use (each of these is a sequence on numbers)
-NTEST = 480           # needs to be big enough to almost guarantee that we will get instances of all 460 comparisons (you get 29 comparisons per sequence)
-MBLOCKS = 24        # ! im concerned about this number # same as fabrices experiment - there are 24 blocks across 3 different contexts
+MTESTSETS: Final[int] = 2     # have multiple test sets for cross-validation of activations
+NTRAIN: Final[int] = 2880       # how many examples we want to use (each of these is a sequence on numbers)
+NTEST: Final[int] = 480           # needs to be big enough to almost guarantee that we will get instances of all 460 comparisons (you get 29 comparisons per sequence)
+MBLOCKS: Final[int] = 24        # ! im concerned about this number # same as fabrices experiment - there are 24 blocks across 3 different contexts
 
 # SN Below info for test long
-NTRAIN_LONG = 10
-NTEST_LONG = 480
-MBLOCKS_LONG = 1 # want to use this for train long only. SN
+NTRAIN_LONG: Final[int] = 10
+NTEST_LONG: Final[int] = 480
+MBLOCKS_LONG: Final[int] = 1 # want to use this for train long only. SN
 # define upper and lower limits for each # range)
 #FULLR_LLIM = 4      # full # range, lower limit
 #FULLR_ULIM = 5     # full # range, upper limit
+
+
+
+# ---------------------------------------------------------------------------- #
+# numpy-backed constants
+# Do not add a top-level numpy import to this module: scripts that only need the directories or integer constants
+# above should not pay for importing numpy. numpy-backed values are registered in _LAZY_NUMPY_CONSTANTS instead,
+# built the first time they are accessed via the module-level __getattr__ (PEP 562), and then cached in globals().
+
+def _numpy():
+    """Import numpy on demand."""
+    import numpy as np
+    return np
+
+
+def _readonly_eye(size):
+    """A read-only one-hot basis; its rows are handed out as shared views, so they must never be written to."""
+    basis = _numpy().eye(size, dtype=INPUT_DTYPE)
+    basis.setflags(write=False)
+    return basis
+
+
+_LAZY_NUMPY_CONSTANTS = {
+    'ONEHOT_NUM': lambda: _readonly_eye(TOTALMAXNUM),       # TOTALMAXNUM x TOTALMAXNUM
+    'ONEHOT_CONTEXT': lambda: _readonly_eye(NCONTEXTS),     # NCONTEXTS x NCONTEXTS
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_NUMPY_CONSTANTS:
+        value = _LAZY_NUMPY_CONSTANTS[name]()
+        globals()[name] = value   # later lookups bypass __getattr__ entirely
+        return value
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_NUMPY_CONSTANTS))
@@ -17,15 +17,19 @@ import matplotlib.pyplot as plt
 import constants as const
 import numpy as np
 import sys
+import os
+import io
+import contextlib
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 import torchvision
-import random
 from sklearn.manifold import MDS
 from sklearn.utils import shuffle
-import copy
 import magnitude_network as mnet
 
 from torch.utils.data import Dataset, DataLoader
@@ -34,37 +38,42 @@ from datetime import datetime
 
 
 def turn_one_hot(integer, maxSize):
-    """This function will take as input an interger and output a one hot representation of that integer up to a max of maxSize."""
-    oneHot = np.zeros((maxSize,1))
-    oneHot[integer-(const.NCONTEXTS-1)] = 1  # SN old version: oneHot[integer-2] = 1 # CF -1 shifts the indexes to the right place
+    """This function will take as input an interger and output a one hot representation of that integer up to a max of maxSize.
+    The result is a read-only view onto the shared const.ONEHOT_NUM/ONEHOT_CONTEXT basis, so copy it before writing to it."""
+    basis = const.ONEHOT_NUM if maxSize == const.TOTALMAXNUM else const.ONEHOT_CONTEXT
+    oneHot = basis[integer-(const.NCONTEXTS-1)]  # shape (maxSize,)  # SN old version: oneHot[integer-2] = 1 # CF -1 shifts the indexes to the right place
     return oneHot
 
 
 def turn_one_hot_to_integer(onehot):
-    """This function will take as input a one hot representation and determine the integer interpretation"""
+    """This function will take as input a one hot representation and determine the integer interpretation.
+    For decoding stored datasets only: create_separate_input_data keeps every number as an integer and never calls this."""
     integer = np.nonzero(onehot)[0]
     return integer+1  # because we are starting counting from 1 not 0
 
 
+def decode_one_hot_rows(onehots, missing):
+    """This function will turn each one hot row of a (..., maxSize) array into its integer (counting from 1), in one vectorised pass,
+    so a single sequence (n, maxSize) or a whole set of sequences (N, n, maxSize) decodes alike. Rows that are all zero decode to missing."""
+    *rows, cols = np.nonzero(onehots)   # one sweep over the array gives the (row, value-1) position of every 1
+    integers = np.full(onehots.shape[:-1], missing, dtype=np.int64)
+    integers[tuple(rows)] = cols + 1
+    return integers
+
+
 def flatten_all_first_dim_arrays(*allarrays):
     """This function will flatten the first dimension of a series of input numpy arrays"""
-    flatarrays = []
-    for array in allarrays:
-        array = flatten_first_dim(array)
-        flatarrays.append(array)
-    return  flatarrays
+    return [flatten_first_dim(array) for array in allarrays]
 
 
 def flatten_first_dim(array):
-    """This function with return a numpy array which flattens the first two dimensions together. Only works for 2d-4d np arrays."""
-    if len(array.shape) == 2:
-        return array.reshape(array.shape[0]*array.shape[1], )
-    elif len(array.shape) == 3:
-        return array.reshape(array.shape[0]*array.shape[1], array.shape[2])
-    elif len(array.shape) == 4:
-        return array.reshape(array.shape[0]*array.shape[1], array.shape[2], array.shape[3])
-    else:
-        print('Error: the array you are trying to partially flatten is not the correct shape.')
+    """This function with return a numpy array which flattens the first two dimensions together (a view for contiguous arrays).
+    Arrays with fewer than 2 dimensions are returned unchanged."""
+    if array.ndim < 2:
+        return array
+    if array.ndim == 2:
+        return array.ravel()
+    return array.reshape(-1, *array.shape[2:])
 
 
 class CreateDataset(Dataset):
@@ -75,6 +84,9 @@ class CreateDataset(Dataset):
     - label
     """
 
+    # sample key -> key of the field in the numpy dataset dict
+    FIELDS = {'index':'index', 'label':'label', 'refValue':'refValue', 'judgementValue':'judgementValue', 'input':'input', 'context':'context', 'contextinput':'contextinputs', 'trialtypeinput':'trialtypeinputs'}
+
     def __init__(self, dataset, transform=None):
         """
         Args:
@@ -82,16 +94,21 @@ class CreateDataset(Dataset):
             transform (callable, optional): Optional transform to be applied on a sample.
         """
         # load all original images too - yes memory intensive but useful. Note that this also removes the efficiency point of using dataloaders
-        self.index = dataset['index']
-        self.label = dataset['label']
-        self.refValue = dataset['refValue']
-        self.judgementValue = dataset['judgementValue']
-        self.input = dataset['input']
-        self.context = dataset['context']
-        self.contextinput = dataset['contextinputs']
-        self.index = (self.index).astype(int)
-        self.trialtypeinput = dataset['trialtypeinputs']
-        self.data = {'index':self.index, 'label':self.label, 'refValue':self.refValue, 'judgementValue':self.judgementValue, 'input':self.input, 'context':self.context, 'contextinput':self.contextinput, "trialtypeinput":self.trialtypeinput}
+        # every field is held once as a tensor sharing memory with the numpy array, so fetching samples only slices tensors
+        with warnings.catch_warnings():  # memory-mapped datasets are read-only, and these tensors are never written to
+            warnings.filterwarnings('ignore', message='The given NumPy array is not writable')
+            self.data = {key: torch.from_numpy(np.ascontiguousarray(dataset[field])) for key, field in self.FIELDS.items()}
+        self.data['index'] = self.data['index'].long()
+        for key in ('label', 'refValue', 'judgementValue', 'input', 'context', 'contextinput'):
+            self.data[key] = self.data[key].float()   # the network's dtype, converted once here rather than per batch (a no-op for float32 datasets)
+        self.index = self.data['index']
+        self.label = self.data['label']
+        self.refValue = self.data['refValue']
+        self.judgementValue = self.data['judgementValue']
+        self.input = self.data['input']
+        self.context = self.data['context']
+        self.contextinput = self.data['contextinput']
+        self.trialtypeinput = self.data['trialtypeinput']
         self.transform = transform
 
     def __len__(self):
@@ -102,17 +119,123 @@ class CreateDataset(Dataset):
         # lets us retrieve several items at once (HRS: may not be actually used)
         if torch.is_tensor(idx):
             idx = idx.tolist()
-        sample = {'index':self.index[idx], 'label':self.label[idx], 'refValue':self.refValue[idx], 'judgementValue':self.judgementValue[idx], 'input':self.input[idx], 'context':self.context[idx], 'contextinput':self.contextinput[idx], 'trialtypeinput':self.trialtypeinput[idx] }
+        sample = {key: value[idx] for key, value in self.data.items()}
+        sample['recurrentinput'] = recurrent_input(sample)   # built from the gathered samples only, so the dataset stays memory-mapped
         return sample
 
+    def __getitems__(self, indices):
+        # used by DataLoader to fetch a whole batch: gather each field once, already stacked (so get_loader collates with collate_batch)
+        return self.__getitem__(list(indices))
+
+
+def collate_batch(batch):
+    """The collate function of get_loader: CreateDataset.__getitems__ already returns the whole batch as a dict of stacked tensors.
+    A module-level function rather than a lambda, so that it can be pickled for the worker processes."""
+    return batch
+
+
+def recurrent_input(data):
+    """The recurrent network's whole input sequence for the samples of a dict of dataset fields (one sequence or a batch):
+    [number one-hot, context one-hot (removed on the filler trials), trial type] at every step"""
+    trialtype = data['trialtypeinput'].float().unsqueeze(-1)
+    return torch.cat((data['input'], data['contextinput'] * (trialtype != 0), trialtype), -1)
+
+
+class ResidentLoader:
+    """Batches (dicts of tensors) sliced in order from a CreateDataset whose fields are all copied onto device once.
+    The datasets are small enough to live on the device whole, so there is no collation, worker or host to device copy per batch."""
+
+    def __init__(self, dataset, batch_size, device):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.data = {key: value.to(device) for key, value in dataset.data.items()}
+        self.data['recurrentinput'] = recurrent_input(self.data)   # held whole on the device too, like every other field
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        for start in range(0, len(self.dataset), self.batch_size):
+            yield {key: value[start:start+self.batch_size] for key, value in self.data.items()}
+
+
+def get_loader(dataset, batch_size, device, shuffle=False, num_workers=0, resident=False):
+    """A DataLoader over a CreateDataset. When the network lives on a CUDA device the batches (dicts of tensors) are
+    collated into pinned memory, so that batch_to_device can copy them asynchronously.
+    With num_workers > 0, persistent worker processes keep a couple of batches each prefetched while the network trains on the
+    current one (batches still arrive in order, which matters when the hidden state is retained across sequences).
+    A deeper prefetch queue does not help here, and only holds more (pinned) batches in memory.
+    With resident=True the whole dataset is instead held on device, and batches are sliced from it in order (a ResidentLoader)."""
+    if resident:
+        return ResidentLoader(dataset, batch_size, device)
+    prefetch = dict(prefetch_factor=2, persistent_workers=True) if num_workers > 0 else {}
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=collate_batch, pin_memory=(torch.device(device).type == 'cuda'), num_workers=num_workers, **prefetch)
+
+
+def batch_to_device(data, device):
+    """Move every tensor of a batch from get_loader onto device (non-blocking from pinned memory; a no-op on the cpu)"""
+    return {key: value.to(device, non_blocking=True) for key, value in data.items()}
+
+
+DATASET_SETS = ('trainset', 'testset', 'crossval_testset')
+
+
+def save_input_data(fileloc, datasetname, dat):
+    """Save a dataset {setname: {field: array}} as a single datasetname.pt file of CPU tensors (torch.save),
+    which read_input_data can memory-map rather than unpickle."""
+    tensors = {setname: {field: torch.from_numpy(np.ascontiguousarray(array)) for field, array in dataset.items()} for setname, dataset in dat.items()}
+    torch.save(tensors, os.path.join(fileloc, datasetname+'.pt'))
+
+
+def dataset_exists(fileloc, datasetname):
+    """Whether a dataset of this name has been saved, as datasetname.pt or in the older single pickled datasetname.npy file"""
+    return any(os.path.exists(os.path.join(fileloc, datasetname+ext)) for ext in ('.pt', '.npy'))
+
+
+def read_input_data(fileloc, datasetname):
+    """Read a dataset saved by save_input_data as {setname: {field: numpy array}}. The arrays are views onto the memory-mapped
+    file, so pages are only read from disk when used. A dataset still in the older single pickled datasetname.npy file is
+    read into memory whole (convert_pickled_dataset resaves it as datasetname.pt)."""
+    datasetfile = os.path.join(fileloc, datasetname+'.pt')
+    if os.path.exists(datasetfile):
+        tensors = torch.load(datasetfile, mmap=True, weights_only=True)
+        dat = {setname: {field: tensor.numpy() for field, tensor in dataset.items()} for setname, dataset in tensors.items()}
+    else:
+        data = np.load(os.path.join(fileloc, datasetname+'.npy'), allow_pickle=True)
+        dat = {setname: data.item().get(setname) for setname in DATASET_SETS}
+    for dataset in dat.values():
+        add_digit_fields(dataset)
+    return dat
+
+
+def convert_pickled_dataset(fileloc, datasetname):
+    """Resave a dataset stored in the older single pickled datasetname.npy file as datasetname.pt, so that read_input_data
+    memory-maps it from then on rather than unpickling it. Does nothing for datasets already saved as datasetname.pt."""
+    if os.path.exists(os.path.join(fileloc, datasetname+'.pt')):
+        return
+    dat = read_input_data(fileloc, datasetname)
+    print('Resaving pickled dataset {} as {}.pt'.format(datasetname, datasetname))
+    save_input_data(fileloc, datasetname, dat)
+
+
+def add_digit_fields(dataset):
+    """Datasets saved before the integer digits fields existed only hold the numbers and contexts as one-hots:
+    decode them once here, so every consumer can read judgementdigits, refdigits and contextdigits directly."""
+    if 'judgementdigits' not in dataset:
+        dataset['judgementdigits'] = decode_one_hot_rows(dataset['judgementValue'], 0).astype(const.DIGITS_DTYPE)
+        dataset['refdigits'] = decode_one_hot_rows(dataset['refValue'], 0).astype(const.DIGITS_DTYPE)
+    if 'contextdigits' not in dataset:
+        dataset['contextdigits'] = decode_one_hot_rows(dataset['context'], -1).astype(const.DIGITS_DTYPE)
+
 
 def load_input_data(fileloc,datasetname):
     # load an existing dataset
-    print('Loading dataset: ' + datasetname + '.npy')
-    data = np.load(fileloc+datasetname+'.npy', allow_pickle=True)
-    numpy_trainset = data.item().get("trainset")
-    numpy_testset = data.item().get("testset")
-    numpy_crossvalset = data.item().get("crossval_testset")
+    print('Loading dataset: ' + datasetname)
+    convert_pickled_dataset(fileloc, datasetname)
+    data = read_input_data(fileloc, datasetname)
+    numpy_trainset = data["trainset"]
+    numpy_testset = data["testset"]
+    numpy_crossvalset = data["crossval_testset"]
 
     # turn out datasets into pytorch Datasets
     trainset = CreateDataset(numpy_trainset)
@@ -122,7 +245,19 @@ def load_input_data(fileloc,datasetname):
     return trainset, testset, crossvalset, numpy_trainset, numpy_testset, numpy_crossvalset
 
 
-def generate_trial_sequence(include_fillers):
+# the single random number generator behind every draw made while generating a dataset (see create_separate_input_data's seed)
+_rng = np.random.default_rng()
+
+
+def _trial_templates(include_fillers):
+    """The three short trial sequences (a compare trial followed by 2, 3 or 4 fillers) as arrays of trial type codes"""
+    other = const.TRIAL_FILLER if include_fillers else const.TRIAL_COMPARE
+    return [np.array([const.TRIAL_COMPARE] + [other]*n, dtype=const.TRIAL_TYPE_DTYPE) for n in (2, 3, 4)]
+
+_TRIAL_TEMPLATES = {True: _trial_templates(True), False: _trial_templates(False)}
+
+
+def generate_trial_sequence(include_fillers, rng=None):
     """
     For generating a sequence of trials combining both the filler task and the compare task, as in Fabrice's experiment
     This will be used in create_separate_input_data()
@@ -130,31 +265,49 @@ def generate_trial_sequence(include_fillers):
      - compare trials are separated by between 2 and 4 filler trials (same as Fabrice's trial scheduling)
      - include_fillers flag determines whether our dataset will contain some filler
     trials like Fabrice used, or whether we have trials solely of the type 'compare'.
+     - returns an int8 array of trial type codes (const.TRIAL_FILLER / const.TRIAL_COMPARE)
+     - rng is the numpy Generator to draw from (default: the module generator)
      """
-    L3_trialtype, L4_trialtype, L5_trialtype= [ [] for i in range(3)]
-
-    # generate 30 sequences, each will different numbers of full range filler trials
-    for i in range(10):
-        # the type of trials in the sequence
-        if include_fillers:
-            L3_trialtype.append([ 'compare','filler','filler'])
-            L4_trialtype.append([ 'compare','filler','filler','filler'])
-            L5_trialtype.append([ 'compare','filler','filler','filler','filler'])
-        else:
-            L3_trialtype.append([ 'compare','compare','compare'])
-            L4_trialtype.append([ 'compare','compare','compare','compare'])
-            L5_trialtype.append([ 'compare','compare','compare','compare','compare'])
-
-    # concatenate and permute the ordering of these sequences
-    type_sequence = [L3_trialtype, L4_trialtype, L5_trialtype]
-    type_sequence = [i for sublist in type_sequence for i in sublist]
-    permorder = np.random.permutation(np.asarray(range(len(type_sequence))))
-    type_sequence = [type_sequence[permorder[i]] for i in range(len(permorder))]
-
-    # flatten the trial sequences
-    type_sequence = [i for sublist in type_sequence for i in sublist]
-
-    return type_sequence
+    rng = _rng if rng is None else rng
+    # 30 sequences, 10 of each template, concatenated in a random order
+    type_sequence = [template for template in _TRIAL_TEMPLATES[bool(include_fillers)] for i in range(10)]
+    permorder = rng.permutation(len(type_sequence))
+    return np.concatenate([type_sequence[i] for i in permorder])
+
+
+def draw_without_adjacent_repeats(values, ndraws, previous, rng=None):
+    """Draw ndraws random indices into values such that no drawn value equals the one drawn before it
+    (the first draw must differ from previous), with exactly the distribution of drawing each value in turn until it differs.
+    - distinct (uniform) values: each index is the one before it plus an offset drawn uniformly from 1..K-1, modulo K
+    - repeated (non-uniform) values: all draws are made at once, then the repeats are redrawn one position at a time"""
+    rng = _rng if rng is None else rng
+    K = len(values)
+    if len(np.unique(values)) == K:
+        start = np.flatnonzero(values == previous)
+        # when previous is not one of the values, nothing constrains the first draw
+        first = start[0] + rng.integers(1, K) if start.size else rng.integers(K)
+        offsets = np.concatenate(([first], rng.integers(1, K, size=max(ndraws-1, 0))))
+        return np.cumsum(offsets)[:ndraws] % K
+    inds = rng.integers(K, size=ndraws)
+    for i in range(ndraws):
+        while values[inds[i]] == previous:
+            inds[i] = rng.integers(K)
+        previous = values[inds[i]]
+    return inds
+
+
+def draw_filler_numbers(fillerRange, isCompare, rng=None):
+    """Draw the numbers for all filler trials (where isCompare is False) of a sequence uniformly from fillerRange.
+    Like Fabrice, a filler directly after a compare trial is never the same as the previous filler."""
+    rng = _rng if rng is None else rng
+    fillerpos = np.flatnonzero(~isCompare)
+    fillerNums = rng.integers(fillerRange[0], fillerRange[1]+1, size=len(fillerpos))
+    afterCompare = isCompare[fillerpos[1:]-1]
+    repeats = afterCompare & (fillerNums[1:] == fillerNums[:-1])
+    while repeats.any():
+        fillerNums[1:][repeats] = rng.integers(fillerRange[0], fillerRange[1]+1, size=np.count_nonzero(repeats))
+        repeats = afterCompare & (fillerNums[1:] == fillerNums[:-1])
+    return fillerNums
 
 
 def turn_index_to_context(randind): # ! confused what this function does ; seems wrong for us
@@ -173,13 +326,182 @@ def turn_index_to_context(randind): # ! confused what this function does ; seems
     return context
 
 
-def create_separate_input_data(filename, args):
+# number distributions that do not depend on the block: fillers span the full range; when the ranges are interleaved,
+# compare numbers are drawn from all 3 context ranges together (non-uniform); train long uses just the linking pair
+FILLER_RANGE = (const.FULLR_LLIM, const.FULLR_ULIM)
+INTERLEAVED_DISTRIBUTION = np.concatenate([np.arange(const.FULLR_LLIM, const.FULLR_ULIM+1), np.arange(const.LOWR_LLIM, const.LOWR_ULIM+1), np.arange(const.HIGHR_LLIM, const.HIGHR_ULIM+1)])
+LINKINGPAIR_DISTRIBUTION = np.arange(const.LOWR_ULIM, const.HIGHR_LLIM+1)
+
+# the per-block arrays returned by generate_block, in the order create_separate_input_data unpacks them
+BLOCK_FIELDS = ('refValue', 'judgementValue', 'input', 'contextinputs', 'label', 'context', 'contextdigits', 'judgementdigits', 'refdigits', 'blocks', 'trialtypeinputs')
+SAVED_FIELDS = ('refValue', 'judgementValue', 'input', 'label', 'context', 'contextdigits', 'judgementdigits', 'refdigits', 'contextinputs', 'trialtypeinputs')  # the block fields kept in the saved dataset
+
+
+def generate_block(block, phase, Mblocks, N, args, seed):
+    """Generate the N/Mblocks sequences of one block of create_separate_input_data's train or test phase.
+    Blocks share no state, so they can be generated in separate processes; seed seeds this block's own random generator.
+    Returns a dict of (N/Mblocks, BPTT_len, ...) arrays keyed by BLOCK_FIELDS."""
+    rng = np.random.default_rng(seed)
+    nsamples = N // Mblocks
+    seqshape = (nsamples, args.BPTT_len)
+    # allocate in the dtypes the network consumes (float32 inputs, one-byte codes) so nothing is downcast later
+    refValues = np.zeros(seqshape + const.DATASET_SHAPES['refValue'], dtype=const.INPUT_DTYPE)
+    judgementValues = np.zeros(seqshape + const.DATASET_SHAPES['judgementValue'], dtype=const.INPUT_DTYPE)
+    input = np.zeros(seqshape + const.DATASET_SHAPES['input'], dtype=const.INPUT_DTYPE)
+    contextinputs = np.zeros(seqshape + const.DATASET_SHAPES['contextinputs'], dtype=const.INPUT_DTYPE)
+    target = np.full(seqshape + const.DATASET_SHAPES['label'], np.nan, dtype=const.INPUT_DTYPE)  # NaN on trials without a label
+    contexts = np.zeros(seqshape + const.DATASET_SHAPES['context'], dtype=const.INPUT_DTYPE)
+    contextdigits = np.zeros(seqshape + const.DATASET_SHAPES['contextdigits'], dtype=const.DIGITS_DTYPE)
+    judgementdigits = np.zeros(seqshape + const.DATASET_SHAPES['judgementdigits'], dtype=const.DIGITS_DTYPE)  # the numbers as integers too, so checks need not decode the one-hots
+    refdigits = np.zeros(seqshape + const.DATASET_SHAPES['refdigits'], dtype=const.DIGITS_DTYPE)              # 0 = no reference yet
+    blocks = np.full((nsamples,1), block, dtype=np.int32)
+    trialTypeInputs = np.zeros(seqshape + const.DATASET_SHAPES['trialtypeinputs'], dtype=const.TRIAL_TYPE_DTYPE)  # const.TrialType codes: 0=filler, 1=compare
+
+    steps = np.arange(args.BPTT_len)                        # row index for scattering one-hots across a sequence
+
+    # Chooses context for this block
+    if phase == 'train':
+        if args.train_long == False: # train short is within the context
+            if args.which_context==0: 
+            # divide the blocks evenly across the 3 contexts
+                if block < Mblocks/const.NCONTEXTS:             # context A    # now 1-4
+                    context = 1
+                    minNumerosity = const.LOWR_LLIM
+                    maxNumerosity = const.LOWR_ULIM
+                    print('minNumerosity: ', minNumerosity, 'maxNumerosity', maxNumerosity)
+                elif block < 2*(Mblocks/const.NCONTEXTS):     # context B    # now 5-8
+                    context = 2
+                    minNumerosity = const.HIGHR_LLIM
+                    maxNumerosity = const.HIGHR_ULIM
+                    print('minNumerosity: ', minNumerosity, 'maxNumerosity: ', maxNumerosity)
+            # single context options
+            elif args.which_context==1:     # context A
+                print('\nlow range context')
+                context = 1
+                minNumerosity = const.LOWR_LLIM
+                maxNumerosity = const.LOWR_ULIM
+            elif args.which_context==2:     # context B
+                print('\nhigh range context')
+                context = 2
+                minNumerosity = const.HIGHR_LLIM
+                maxNumerosity = const.HIGHR_ULIM
+        else:   # train long is just the linking pair
+            print('train long')
+            minNumerosity = const.LOWR_ULIM
+            maxNumerosity = const.HIGHR_LLIM
+    else:
+        # sets the numerosity to test the whole set (both contexts) for short and long
+        print('args.train_long: ', args.train_long, 'phase: ', phase)
+        minNumerosity = const.FULLR_LLIM
+        maxNumerosity = const.FULLR_ULIM
+
+    # set the range of numerosities for the context
+    if args.train_long == True and phase == 'train': # Train long should only be on the linking pair between contexts
+        randNumArr = LINKINGPAIR_DISTRIBUTION
+    else: # The whole range (information for linking pair is filtered out later)
+        if args.all_fullrange: # args.all_fullrange == True = interleaved 
+            randNumArr = INTERLEAVED_DISTRIBUTION
+        else: # args.all_fullrange == False = blocked
+            randNumArr = np.arange(minNumerosity, maxNumerosity+1)  # uniform between min and max
+    print('randNumDistribution: ', randNumArr)
+
+    # generate some random numerosity data and label whether the random judgement integers are larger than the refValue
+    firstTrialInContext = True              # reset the sequentialAB structure for each new context
+    lastContext = context if phase == 'train' and not args.train_long else 1  # context carried into a sequence that opens with filler trials
+    for sample in range(nsamples):    # each sequence
+        type_sequence  = generate_trial_sequence(args.include_fillers, rng) # the order of filler trial and compare trials
+        trialtypeinput = type_sequence[:args.BPTT_len]     # provide a bit-flip input to say whether its a filler or compare trial
+        # draw the numbers for every trial in the sequence up front
+        isCompare = trialtypeinput == const.TRIAL_COMPARE
+        if firstTrialInContext:
+            if not isCompare[0]:
+                print('Warning: sequence starting with a filler trial. This should not happen and will cause a bug in sequence generation.')
+            judgementValue = randNumArr[rng.integers(len(randNumArr))]  # reference for the first compare trial in this context
+        judgement_ints = np.empty(args.BPTT_len, dtype=int)  # the number on each trial; everything below reads these integers, one-hots are only written out
+        judgement_ints[isCompare] = randNumArr[draw_without_adjacent_repeats(randNumArr, np.count_nonzero(isCompare), judgementValue, rng)]
+        judgement_ints[~isCompare] = draw_filler_numbers(FILLER_RANGE, isCompare, rng)
+        comparepos = np.flatnonzero(isCompare)
+        judgeValues = judgement_ints[comparepos]
+        nCompares = np.cumsum(isCompare)   # number of compare trials up to and including each trial
+
+        # the true context of each trial
+        if args.all_fullrange or args.train_long or phase == 'test':  # if intermingling contexts, then we need to know which context each number was sampled from
+            compareContexts = np.where(judgeValues <= const.LOWR_ULIM, 1, 2)   # as turn_index_to_context
+            contextsequence = np.where(nCompares > 0, compareContexts[nCompares-1], lastContext)  # fillers keep the context of the compare trial before them
+        else:
+            contextsequence = np.full(args.BPTT_len, context)
+        if args.all_fullrange:
+            # when the trials are interleaved, set filler trials to have random contets
+            # (NOTE this doesnt actually matter because context is later zeroed on fillers)
+            contextsequence[~isCompare] = rng.integers(1, const.NCONTEXTS+1, size=args.BPTT_len-len(comparepos)) # 1 or 2
+
+        # Define the context input to the network
+        if args.label_context=='true':
+            contextinputsequence = contextsequence  # there are 2 different contexts
+        elif args.label_context=='random':
+            # Note that NOT changing 'context' means that we should be able to see the correct range label in the RDM
+            contextinputsequence = rng.integers(1, const.NCONTEXTS+1, size=args.BPTT_len)  # randomly assign each example to a context, (shuffling examples across context markers in training)
+        elif args.label_context=='constant':
+            # Note that NOT changing 'context' means that we should be able to see the correct range label in the RDM
+            contextinputsequence = np.ones(args.BPTT_len, dtype=int) # just keep this constant across all contexts, so the input doesnt contain an explicit context indicator
+
+        lastContext = contextsequence[-1]
+        if firstTrialInContext:
+            judgementValue = judgement_ints[-1]  # and then make sure that the next sequence starts where this one left off (bit of a hack)
+            firstTrialInContext = False
+        else:
+            judgementValue = judgeValues[-1]
+
+        # determine the correct rel. magnitude judgement for each pair of adjacent numbers in the sequence
+        # (each compare trial is judged against the previous compare trial; the first one has no label)
+        if np.any(judgeValues[1:] == judgeValues[:-1]):
+            print('Warning: something gone wrong at index {}.'.format(comparepos[1:][judgeValues[1:] == judgeValues[:-1]]))
+        labels = np.greater(judgeValues[1:], judgeValues[:-1]).astype(const.INPUT_DTYPE)
+        if args.train_long == False:  #SN don't want to do below for test long. could also add args.all_fullrange == True into statement
+            crossesContexts = ((judgeValues[1:] <= const.LOWR_ULIM) & (judgeValues[:-1] >= const.HIGHR_LLIM)) | ((judgeValues[1:] >= const.HIGHR_LLIM) & (judgeValues[:-1] <= const.LOWR_ULIM))
+            labels[crossesContexts] = np.nan
+        target[sample, comparepos[1:]] = labels
+
+        # the reference on every trial is the most recent compare number before it (0 = no reference yet)
+        nPreviousCompares = nCompares - isCompare
+        ref_ints = np.where(nPreviousCompares > 0, judgeValues[nPreviousCompares-1], 0)
+
+        contextdigits[sample] = contextsequence
+        judgementdigits[sample] = judgement_ints
+        refdigits[sample] = ref_ints
+        # scatter the one-hots straight into the (zero-initialised) dataset arrays (no reference yet -> all-zero row)
+        judgementValues[sample][steps, judgement_ints-(const.NCONTEXTS-1)] = 1
+        hasRef = ref_ints > 0
+        refValues[sample][steps[hasRef], ref_ints[hasRef]-(const.NCONTEXTS-1)] = 1
+        contexts[sample][steps, contextsequence-(const.NCONTEXTS-1)] = 1  # still captures context here even if we dont feed context label into network
+        contextinputs[sample][steps, contextinputsequence-(const.NCONTEXTS-1)] = 1
+        #input[sample] = np.squeeze(np.concatenate((input2,input1,contextinput)))  # for the MLP
+        input[sample][steps, judgement_ints-(const.NCONTEXTS-1)] = 1             # for the RNN with BPTT
+        trialTypeInputs[sample] = trialtypeinput
+
+    return dict(zip(BLOCK_FIELDS, (refValues, judgementValues, input, contextinputs, target, contexts, contextdigits, judgementdigits, refdigits, blocks, trialTypeInputs)))
+
+
+def finalize_phase_data(blockarrays, indices):
+    """This function flattens the (Mblocks, N/Mblocks, ...) block arrays of one phase across their first two dims
+    and assembles them, with the sequence indices, into the dataset dict that gets saved."""
+    dataset = {key: flatten_first_dim(blockarrays[key]) for key in SAVED_FIELDS}
+    dataset['index'] = flatten_first_dim(indices)
+    return dataset
+
+
+def create_separate_input_data(filename, args, seed=None, njobs=None):
     """This function will create a dataset of inputs for training/testing a network on a relational magnitude task.
     - There are 3 contexts if whichContext==0 (default), or just one range for any other value of whichContext (1-3).
     - the inputs to this function determine the structure in the training and test sets e.g. are they blocked by context.
     - BPTT_len specifies how long to back the sequences we backprop through. So far only works for BPTT_len <= block length
     - messy but functional. To be modularised.
+    - seed: if given, the dataset generator is reseeded with it so that the dataset can be reproduced exactly.
+    - njobs: number of processes to generate blocks in (default: one per block, up to one per cpu; 1 generates them in this process).
     """
+    global _rng
+    if seed is not None:
+        _rng = np.random.default_rng(seed)
     print('Generating dataset...')
     if args.which_context==0:
         print('- all contexts included')
@@ -225,262 +547,42 @@ def create_separate_input_data(filename, args):
     testsets = [[] for i in range(Mtestsets)]
     whichtestset = 0                         # a counter
 
-    for phase in phases:   # this method should balance context instances in train and test phases
-        # appropriately set Mblocks and N values for the phase and short/long set
-        if phase == 'train':
-            N = copy.copy(Ntrain)
-            if args.train_long == True:
-                Mblocks = const.MBLOCKS_LONG
-            else:
-                Mblocks = const.MBLOCKS
-        else:
-            N = copy.copy(Ntest)
-            Mblocks = const.MBLOCKS
-
-        # perhaps set temporary N to N/24, then generate the data under each context and then shuffle order at the end?
-        refValues = np.empty((Mblocks, int(N/Mblocks),args.BPTT_len, const.TOTALMAXNUM))
-        judgementValues = np.empty((Mblocks, int(N/Mblocks),args.BPTT_len, const.TOTALMAXNUM))
-        input = np.empty((Mblocks, int(N/Mblocks),args.BPTT_len, const.TOTALMAXNUM))
-        contextinputs = np.empty((Mblocks, int(N/Mblocks), args.BPTT_len, const.NCONTEXTS ))
-        target = np.empty((Mblocks, int(N/Mblocks),args.BPTT_len))
-        contexts = np.empty((Mblocks, int(N/Mblocks), args.BPTT_len, const.NCONTEXTS))
-        contextdigits = np.empty((Mblocks, int(N/Mblocks),args.BPTT_len))
-        blocks = np.empty((Mblocks, int(N/Mblocks),1))
-        trialTypes = np.empty((Mblocks, int(N/Mblocks), args.BPTT_len), dtype='str')  # 0='filler, 1='compare'; pytorch doesnt like string numpy arrays
-        trialTypeInputs = np.empty((Mblocks, int(N/Mblocks), args.BPTT_len))
-        if phase == 'train':
-            trainindices = (np.asarray([i for i in range(Ntrain)])).reshape((Mblocks, int(Ntrain/Mblocks),1))
-        else:
-            testindices = (np.asarray([i for i in range(Ntest)])).reshape((Mblocks, int(Ntest/Mblocks),1))
+    # appropriately set Mblocks for each phase and short/long set,
+    # and never start more processes than there are blocks to generate in a phase (each one imports torch and this module again)
+    phaseblocks = [const.MBLOCKS_LONG if (phase == 'train' and args.train_long) else const.MBLOCKS for phase in phases]
+    if njobs is None:
+        njobs = min(max(phaseblocks), os.cpu_count() or 1)
 
-        fillerRange = [const.FULLR_LLIM,const.FULLR_ULIM]        # the range of numbers spanned by all filler trials
+    # the with block shuts the worker processes down even if generating a phase fails
+    with (ProcessPoolExecutor(njobs) if njobs != 1 else contextlib.nullcontext()) as pool:
+        mapper = pool.map if pool is not None else map
 
-        # print('args.train_long: ', args.train_long, 'phase: ', phase)
-        
-        for block in range(Mblocks): # Chooses context for each block
-            if phase == 'train':
-                if args.train_long == False: # train short is within the context
-                    if args.which_context==0: 
-                    # divide the blocks evenly across the 3 contexts
-                        if block < Mblocks/const.NCONTEXTS:             # context A    # now 1-4
-                            context = 1
-                            minNumerosity = const.LOWR_LLIM
-                            maxNumerosity = const.LOWR_ULIM
-                            print('minNumerosity: ', minNumerosity, 'maxNumerosity', maxNumerosity)
-                        elif block < 2*(Mblocks/const.NCONTEXTS):     # context B    # now 5-8
-                            context = 2
-                            minNumerosity = const.HIGHR_LLIM
-                            maxNumerosity = const.HIGHR_ULIM
-                            print('minNumerosity: ', minNumerosity, 'maxNumerosity: ', maxNumerosity)
-                    # single context options
-                    elif args.which_context==1:     # context A
-                        print('\nlow range context')
-                        context = 1
-                        minNumerosity = const.LOWR_LLIM
-                        maxNumerosity = const.LOWR_ULIM
-                    elif args.which_context==2:     # context B
-                        print('\nhigh range context')
-                        context = 2
-                        minNumerosity = const.HIGHR_LLIM
-                        maxNumerosity = const.HIGHR_ULIM
-                else:   # train long is just the linking pair
-                    print('train long')
-                    minNumerosity = const.LOWR_ULIM
-                    maxNumerosity = const.HIGHR_LLIM
-            else:
-                # sets the numerosity to test the whole set (both contexts) for short and long
-                print('args.train_long: ', args.train_long, 'phase: ', phase)
-                minNumerosity = const.FULLR_LLIM
-                maxNumerosity = const.FULLR_ULIM
-    
-            # set the range of numerosities for the context
-            if args.train_long == True and phase == 'train': # Train long should only be on the linking pair between contexts
-                randNumDistribution = Mtestsets = [i for i in range(const.LOWR_ULIM, const.HIGHR_LLIM+1)]
-            else: # The whole range (information for linking pair is filtered out later)
-                if args.all_fullrange: # args.all_fullrange == True = interleaved 
-                    # print('interleaved')
-                    tmpDistribution = [[i for i in range(const.FULLR_LLIM, const.FULLR_ULIM+1)],[j for j in range(const.LOWR_LLIM, const.LOWR_ULIM+1)], [k for k in range(const.HIGHR_LLIM, const.HIGHR_ULIM+1)]]
-                    randNumDistribution = [i for sublist in tmpDistribution for i in sublist]  # non-uniform distr. over all 3 context ranges together
-                else: # args.all_fullrange == False = blocked
-                    # print('blocked')
-                    randNumDistribution = [i for i in range(minNumerosity, maxNumerosity+1)]  # uniform between min and max
-            
-            indexDistribution = [i for i in range(len(randNumDistribution))]  # this is going to allow us to know which context a sample which have been drawn from if intermingled
-            print('randNumDistribution: ', randNumDistribution)
-            print('indexDistribution: ', indexDistribution)
-            
-            # generate some random numerosity data and label whether the random judgement integers are larger than the refValue
-            firstTrialInContext = True              # reset the sequentialAB structure for each new context
-            for sample in range(int(N/Mblocks)):    # each sequence
-                input_sequence = []
-                type_sequence  = generate_trial_sequence(args.include_fillers) # the order of filler trial and compare trials
-                trialtypeinput = [0 for i in range(len(type_sequence))]
-                contextsequence = []
-                contextinputsequence = []
-                previousFillerNum = None
-                previousTrialtype = None
-
-                # generate adjacent sequences of inputs, where no two adjacent elements within (or between) a sequence are the same
-                for item in range(args.BPTT_len):
-                    trial_type = type_sequence[item]
-                    trialtypeinput[item] = 1 if trial_type=='compare' else 0    # provide a bit-flip input to say whether its a filler or compare trial
-
-                    if trial_type == 'compare':
-                        if (firstTrialInContext and (item==0)):
-                            randind = random.choice(indexDistribution)
-                            # SN print index distribution and randomNumDistribution to screen
-                            # print('randind: ', randind)
-                            refValue = randNumDistribution[randind]
-                            if trial_type == 'filler':
-                                print('Warning: sequence starting with a filler trial. This should not happen and will cause a bug in sequence generation.')
-                        else:
-                            refValue = copy.deepcopy(judgementValue)  # use the previous number and make sure its a copy not a reference to same piece of memory
-
-                        randind = random.choice(indexDistribution)
-                        
-                        judgementValue = randNumDistribution[randind]
-                        
-                        #SN print judgement value and randNumDistribution to screen to be sure
-                        #print('judgementValue: ', judgementValue)
-                        #print('randNumDistribution: ', randNumDistribution)
-
-                        while refValue==judgementValue:    # make sure we dont do inputA==inputB for two adjacent inputs
-                            randind = random.choice(indexDistribution)
-                            judgementValue = randNumDistribution[randind] 
-                        
-                        input2 = turn_one_hot(judgementValue, const.TOTALMAXNUM)
-                        if args.all_fullrange or args.train_long or phase == 'test':  # if intermingling contexts, then we need to know which context this number was sampled from
-                            context = turn_index_to_context(randNumDistribution[randind]) 
-
-                    else:  # filler trial (note fillers are always from uniform 1:15 range)
-                        input2 = turn_one_hot(random.randint(*fillerRange), const.TOTALMAXNUM)
-                        # make sure (like Fabrice) that after a compare trial the subsequent filler isnt the same as the previous filler
-                        if previousFillerNum is not None and previousTrialtype=='compare':
-                            while all(input2 == previousFillerNum):
-                                input2 = turn_one_hot(random.randint(*fillerRange), const.TOTALMAXNUM) # leave the filler numbers unconstrained just spanning the full range
-
-                        previousFillerNum = copy.copy(input2)
-                        # when the trials are interleaved, set filler trials to have random contets
-                        # (NOTE this doesnt actually matter because context is later zeroed on fillers)
-                        if args.all_fullrange:
-                            context = random.randint(1, const.NCONTEXTS) # 1 or 2 
-
-                    previousTrialtype = copy.copy(trial_type)
-
-                    # Define the context input to the network
-                    if args.label_context=='true':
-                        contextinput = turn_one_hot(context, const.NCONTEXTS)  # there are 2 different contexts
-                    elif args.label_context=='random':
-                        # Note that NOT changing 'context' means that we should be able to see the correct range label in the RDM
-                        contextinput = turn_one_hot(random.randint(1,3), const.NCONTEXTS)  # randomly assign each example to a context, (shuffling examples across context markers in training)
-                    elif args.label_context=='constant':
-                        # Note that NOT changing 'context' means that we should be able to see the correct range label in the RDM
-                        contextinput = turn_one_hot(1, const.NCONTEXTS) # just keep this constant across all contexts, so the input doesnt contain an explicit context indicator
-
-                    # add our new inputs to our sequence
-                    input_sequence.append(input2)
-                    contextsequence.append(context)
-                    contextinputsequence.append(contextinput)
-
-                if firstTrialInContext:
-                    judgementValue = turn_one_hot_to_integer(input_sequence[-1])  # and then make sure that the next sequence starts where this one left off (bit of a hack)
-                    firstTrialInContext = False
-
-                # determine the correct rel. magnitude judgement for each pair of adjacent numbers in the sequence
-                rValue = None
-                judgeValue = None
-                allJValues = np.zeros((args.BPTT_len, const.TOTALMAXNUM))
-                allRValues = np.zeros((args.BPTT_len, const.TOTALMAXNUM))
-                
-                for i in range(args.BPTT_len):
-                    trialtype = trialtypeinput[i]
-                    if trialtype==1:  # compare
-                        judgeValue = turn_one_hot_to_integer(input_sequence[i])
-                        if rValue is not None:
-                            if judgeValue==rValue:
-                                print('Warning: something gone wrong at index {}.'.format(i))
-
-                            if judgeValue > rValue:
-                                target[block, sample, i] = 1
-                            else:
-                                target[block, sample, i] = 0
-                                #SN don't want to do below for test long. could also add args.all_fullrange == True into statement
-                            if args.train_long == False:
-                                if (judgeValue <= const.LOWR_ULIM and rValue >= const.HIGHR_LLIM) or (judgeValue >= const.HIGHR_LLIM and rValue <= const.LOWR_ULIM):
-                                    target[block, sample, i] = np.nan
-                        else:
-                            target[block, sample, i] = None  # default dont do anything
-
-                    allJValues[i] = np.squeeze(turn_one_hot(turn_one_hot_to_integer(input_sequence[i]), const.TOTALMAXNUM))
-                    #print('allJValues[i]: ', allJValues[i])
-                    if rValue is None:
-                        allRValues[i] = np.zeros((const.TOTALMAXNUM,))
-                    else:
-                        allRValues[i] = np.squeeze(turn_one_hot(rValue, const.TOTALMAXNUM))
-
-                    if trialtype==1:
-                        rValue = turn_one_hot_to_integer(input_sequence[i])  # set the previous state to be the current state
-
-                #print('judgeValue: ', judgeValue)
-                if firstTrialInContext:
-                    judgementValue = copy.deepcopy(judgeValue)    # and then make sure that the next sequence starts with judgement where this one left off
-                contextdigits[block, sample] = contextsequence
-                judgementValues[block, sample] = np.squeeze(np.asarray(allJValues))
-                refValues[block, sample] = np.squeeze(np.asarray(allRValues))
-                contexts[block, sample] = np.squeeze([turn_one_hot(contextsequence[i], const.NCONTEXTS) for i in range(len(contextsequence))])  # still captures context here even if we dont feed context label into network
-                contextinputs[block, sample] = np.squeeze(contextinputsequence)
-                #input[block, sample] = np.squeeze(np.concatenate((input2,input1,contextinput)))  # for the MLP
-                input[block, sample] = np.squeeze(np.asarray(input_sequence))             # for the RNN with BPTT
-                blocks[block, sample] = block
-                trialTypes[block, sample] = type_sequence
-                trialTypeInputs[block, sample] = trialtypeinput
-        
-        if phase=='train':
+        for phase, Mblocks in zip(phases, phaseblocks):   # this method should balance context instances in train and test phases
+            N = Ntrain if phase == 'train' else Ntest
 
-            # now shuffle the training block order so that we temporally separate contexts a bit but still blocked
-           # input, refValues, judgementValues, target, contexts, contextdigits, trainindices, blocks, contextinputs, trialTypeInputs = shuffle(input, refValues, judgementValues, target, contexts, contextdigits, trainindices, blocks, contextinputs, trialTypeInputs, random_state=0)
-
-            # now flatten across the first dim of the structure
-            input = flatten_first_dim(input)
-            refValues = flatten_first_dim(refValues)
-            judgementValues = flatten_first_dim(judgementValues)
-            #print('judgementValues: ', judgementValues)
-            target = flatten_first_dim(target)
-            contexts = flatten_first_dim(contexts)
-            contextdigits = flatten_first_dim(contextdigits)
-            trainindices = flatten_first_dim(trainindices)
-            blocks = flatten_first_dim(blocks)
-            contextinputs = flatten_first_dim(contextinputs)
-            trialTypeInputs  = flatten_first_dim(trialTypeInputs)
-
-            trainset = { 'refValue':refValues, 'judgementValue':judgementValues, 'input':input, 'label':target, 'index':trainindices, 'context':contexts, 'contextdigits':contextdigits, 'contextinputs':contextinputs, "trialtypeinputs":trialTypeInputs }
-        else:
+            # perhaps set temporary N to N/24, then generate the data under each context and then shuffle order at the end?
+            # each block is generated independently (with its own random seed), in parallel across processes
+            blockseeds = _rng.integers(np.iinfo(np.int64).max, size=Mblocks)
+            blockdata = list(mapper(generate_block, range(Mblocks), repeat(phase, Mblocks), repeat(Mblocks, Mblocks), repeat(N, Mblocks), repeat(args, Mblocks), blockseeds))
+            blockarrays = {key: np.stack([data[key] for data in blockdata]) for key in BLOCK_FIELDS}
+            indices = np.arange(N).reshape((Mblocks, N // Mblocks, 1))
 
             # now shuffle the training block order so that we temporally separate contexts a bit but still blocked
-            # input, refValues, judgementValues, target, contexts, contextdigits, testindices, blocks, contextinputs, trialTypeInputs = shuffle(input, refValues, judgementValues, target, contexts, contextdigits, testindices, blocks, contextinputs, trialTypeInputs,  random_state=0)
-
-            # now flatten across the first dim of the structure
-            input = flatten_first_dim(input)
-            refValues = flatten_first_dim(refValues)
-            judgementValues = flatten_first_dim(judgementValues)
-            #print('judgementValues: ', judgementValues)
-            target = flatten_first_dim(target)
-            contexts = flatten_first_dim(contexts)
-            contextdigits = flatten_first_dim(contextdigits)
-            testindices = flatten_first_dim(testindices)
-            blocks = flatten_first_dim(blocks)
-            contextinputs = flatten_first_dim(contextinputs)
-            trialTypeInputs  = flatten_first_dim(trialTypeInputs)
-
-            testsets[whichtestset] = { 'refValue':refValues, 'judgementValue':judgementValues, 'input':input, 'label':target, 'index':testindices, 'context':contexts, 'contextdigits':contextdigits, 'contextinputs':contextinputs, "trialtypeinputs":trialTypeInputs }
-            whichtestset += 1
+            # input, refValues, judgementValues, target, contexts, contextdigits, indices, blocks, contextinputs, trialTypeInputs = shuffle(input, refValues, judgementValues, target, contexts, contextdigits, indices, blocks, contextinputs, trialTypeInputs, random_state=0)
+
+            dataset = finalize_phase_data(blockarrays, indices)
+            if phase == 'train':
+                trainset = dataset
+            else:
+                testsets[whichtestset] = dataset
+                whichtestset += 1
 
     # save the dataset so we can use it again
     testset = testsets[0]
     crossvalset = testsets[1]
     dat = {"trainset":trainset, "testset":testset, "crossval_testset":crossvalset}
-    print(const.DATASET_DIRECTORY+filename)
-    np.save(const.DATASET_DIRECTORY+filename+'.npy', dat)
+    print(const.DATASET_DIRECTORY / filename)
+    save_input_data(const.DATASET_DIRECTORY, filename, dat)
 
     # turn out datasets into pytorch Datasets
     trainset = CreateDataset(trainset)
@@ -488,82 +590,92 @@ def create_separate_input_data(filename, args):
 
     return trainset, testset
 
+# one record per trial, for checking a dataset (see decode_sequence)
+TRIAL_RECORD = np.dtype([('judgementValue', const.DIGITS_DTYPE), ('refValue', const.DIGITS_DTYPE), ('label', const.INPUT_DTYPE), ('context', const.DIGITS_DTYPE)])
+
+
+def decode_sequence(numpyset, array_index):
+    """This function will return the judgementValue, refValue, label and context of every trial of one sequence (or a slice of
+    sequences) of a numpy dataset from read_input_data, packed into one TRIAL_RECORD array (0 = no number, -1 = no context)."""
+    judgementValues = numpyset['judgementdigits'][array_index]
+    trials = np.empty(judgementValues.shape, dtype=TRIAL_RECORD)
+    trials['judgementValue'] = judgementValues
+    trials['refValue'] = numpyset['refdigits'][array_index]
+    trials['label'] = numpyset['label'][array_index].reshape(judgementValues.shape)
+    trials['context'] = numpyset['contextdigits'][array_index]
+    return trials
+
+
+def check_sequence(trials, args):
+    """This function will check whether the judgementValue and refValue logic is correct for every trial of a decoded sequence at once.
+    Only trials that have both a judgementValue and a refValue are compared (0 marks an all-zero one-hot row).
+    Returns boolean masks (wrongLabel, wrongContext, wrongNaN), each trial flagged by at most one of them in that order of priority:
+    - wrongLabel: the label disagrees with the comparison of judgementValue and refValue
+    - wrongContext: the context does not match the range of judgementValue (short sequences only)
+    - wrongNaN: a comparison across contexts has a label rather than NaN (short sequences only)"""
+    judgementValues, refValues, labels, contexts = trials['judgementValue'], trials['refValue'], trials['label'], trials['context']
+    isPair = (judgementValues > 0) & (refValues > 0)   # trials with both numbers present (the refValue row is all-zero before the first compare trial)
+    wrongLabel = (((judgementValues < refValues) & (labels == 1)) | ((judgementValues > refValues) & (labels == 0))) & isPair
+    checkContext = not args.train_long   # long sequences cross contexts by design, so only the labels are checked
+    if not checkContext:
+        nothing = np.zeros_like(wrongLabel)
+        return wrongLabel, nothing, nothing
+    wrongContext = (((judgementValues <= const.LOWR_ULIM) & (contexts == 2)) | ((judgementValues >= const.HIGHR_LLIM) & (contexts == 1))) & ~wrongLabel
+    crossesContexts = ((judgementValues <= const.LOWR_ULIM) & (refValues >= const.HIGHR_LLIM)) | ((judgementValues >= const.HIGHR_LLIM) & (refValues <= const.LOWR_ULIM))
+    wrongNaN = crossesContexts & isPair & ((labels == 1) | (labels == 0)) & ~wrongLabel & ~wrongContext
+    return wrongLabel, wrongContext, wrongNaN
+
+
+def sequence_report(trials, checks):
+    """This function will format one line per trial of a decoded sequence, followed by the message of each (mask, message)
+    check that flags that trial, and return the whole report as a single string so it can be printed in one call."""
+    notes = np.full(len(trials), '', dtype=object)
+    for mask, message in checks:
+        notes[np.flatnonzero(mask)] += '\n\t' + message   # only the flagged trials are touched
+    report = io.StringIO()  # numpy formats all the trial lines in one go
+    np.savetxt(report, trials, fmt='judgementValue: %d \trefValue: %d \tlabel: %g \tcontext: %d')
+    lines = np.char.add(report.getvalue().splitlines(), notes.astype(str))
+    return '\n'.join(lines)
+
+
+def validate_split(numpyset, array_index, args, name, checkNaN=True):
+    """This function will decode and check one sequence of a numpy dataset (train or test set) and print the report for it.
+    checkNaN: whether to also flag comparisons across contexts that have a label rather than NaN."""
+    print(name + '...')
+    trials = decode_sequence(numpyset, array_index)
+    wrongLabel, wrongContext, wrongNaN = check_sequence(trials, args)
+    checks = [(wrongLabel, 'WRONG label!'), (wrongContext, 'WRONG context!')]
+    if checkNaN:
+        checks.append((wrongNaN, 'WRONG label != NaN!'))
+    print(sequence_report(trials, checks))
+
+    # the same checks over every sequence of the set at once
+    wrongLabel, wrongContext, wrongNaN = check_sequence(decode_sequence(numpyset, slice(None)), args)
+    print('{} whole set: {} WRONG label, {} WRONG context{}'.format(name, np.count_nonzero(wrongLabel), np.count_nonzero(wrongContext), ', {} WRONG label != NaN'.format(np.count_nonzero(wrongNaN)) if checkNaN else ''))
+
+
 def view_dataset_index_info(array_index, args):
     '''
     This function will print out the information of the dataset at the given index. Used to compare judgementValue, 
-    refValue, label, and context to ensure the dataset is correct.
+    refValue, label, and context to ensure the dataset is correct. Only runs when args.verify_dataset is set (--verify-dataset).
     '''
+    if not args.verify_dataset:
+        return
     datasetname, trained_modelname, analysis_name, _ = mnet.get_dataset_name(args)
-    trainset, testset, crossvalset, numpy_trainset, numpy_testset, numpy_crossvalset = load_input_data(const.DATASET_DIRECTORY, datasetname)
+    data = read_input_data(const.DATASET_DIRECTORY, datasetname)  # only the numpy arrays are checked, so no pytorch Datasets are built
+    numpy_trainset, numpy_testset = data["trainset"], data["testset"]
     # array_index = -50 # choose an index to check the dataset (check multiple indexes)
     print('array_index:',array_index)
     # print('judgementValue:',numpy_trainset['judgementValue'][array_index])
     # print('refValue:',numpy_trainset['refValue'][array_index])
     # print('label:',numpy_trainset['label'][array_index])
     #print('context:',numpy_trainset['context'][array_index])
-    print('Trainset...')
-    for i in range(len(numpy_trainset['judgementValue'][array_index])):
-        judgementValue = 0
-        refValue = 0
-        label = 0
-        context = -1
-        # turn judgementValarray position to value
-        for ind in range(len(numpy_trainset['judgementValue'][array_index][i])):
-            if numpy_trainset['judgementValue'][array_index][i][ind] == 1:
-                judgementValue = ind + 1
-        # turn refValue array position to value  
-        for ind in range(len(numpy_trainset['refValue'][array_index][i])):
-            if numpy_trainset['refValue'][array_index][i][ind] == 1:
-                refValue = ind + 1
-        # grab label value
-        label = numpy_trainset['label'][array_index][i]
-        # grab context value
-        for ind in range(len(numpy_trainset['context'][array_index][i])):
-            if numpy_trainset['context'][array_index][i][ind] == 1:
-                context = ind + 1
-        # check if the judgementValue and refValue logic is correct
-        
-        print('judgementValue:',judgementValue, '\trefValue:',refValue, '\tlabel:',label, '\tcontext:',context)
-        if (judgementValue < refValue and label == 1) or (judgementValue > refValue and label == 0):
-          print('\tWRONG label!')
-        elif ((judgementValue <= const.LOWR_ULIM and context == 2) or (judgementValue >= const.HIGHR_LLIM and context == 1)) and args.train_long == False:
-          print('\tWRONG context!')
-        elif ((judgementValue <= const.LOWR_ULIM and refValue >= const.HIGHR_LLIM) or (judgementValue >= const.HIGHR_LLIM and refValue <= const.LOWR_ULIM)) and (label == 1 or label == 0):
-          if args.train_long == False:
-            print('\tWRONG label != NaN!')
-    print('Testset...')
-    for i in range(len(numpy_testset['judgementValue'][array_index])):
-        judgementValue = 0
-        refValue = 0
-        label = 0
-        context = -1
-        # turn judgementValarray position to value
-        for ind in range(len(numpy_testset['judgementValue'][array_index][i])):
-            if numpy_testset['judgementValue'][array_index][i][ind] == 1:
-                judgementValue = ind + 1
-        # turn refValue array position to value  
-        for ind in range(len(numpy_testset['refValue'][array_index][i])):
-            if numpy_testset['refValue'][array_index][i][ind] == 1:
-                refValue = ind + 1
-        # grab label value
-        label = numpy_testset['label'][array_index][i]
-        # grab context value
-        for ind in range(len(numpy_testset['context'][array_index][i])):
-            if numpy_testset['context'][array_index][i][ind] == 1:
-                context = ind + 1
-        # check if the judgementValue and refValue logic is correct
-        
-        print('judgementValue:',judgementValue, '\trefValue:',refValue, '\tlabel:',label, '\tcontext:',context)
-        if (judgementValue < refValue and label == 1) or (judgementValue > refValue and label == 0):
-          print('\tWRONG label!')
-        elif ((judgementValue <= const.LOWR_ULIM and context == 2) or (judgementValue >= const.HIGHR_LLIM and context == 1)) and args.train_long == False:
-          print('\tWRONG context!')
-          
+    validate_split(numpy_trainset, array_index, args, 'Trainset')
+    validate_split(numpy_testset, array_index, args, 'Testset', checkNaN=False)
+
 def create_dataset(args):
     datasetname, trained_modelname, analysis_name, _ = mnet.get_dataset_name(args)
     if args.create_new_dataset:
         print('Creating new dataset...')
         create_separate_input_data(datasetname, args)
-        data = np.load(const.DATASET_DIRECTORY+datasetname+'.npy', allow_pickle=True)
-        numpy_trainset = data.item().get("trainset")
-        #print(numpy_trainset['judgementValue'][4])
\ No newline at end of file
+        # the saved arrays are not needed here; read_input_data(const.DATASET_DIRECTORY, datasetname) when inspecting them
@@ -18,7 +18,6 @@ import matplotlib.pyplot as plt
 import constants as const
 import plotter as mplt
 import numpy as np
-import copy
 import sys
 import random
 import json
@@ -29,6 +28,7 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
+import torch.utils.checkpoint
 import torchvision
 from sklearn.manifold import MDS
 from sklearn.utils import shuffle
@@ -39,8 +39,11 @@ from torch.utils.tensorboard import SummaryWriter
 from datetime import datetime
 from itertools import product
 import argparse
+import queue
+import threading
 
-torch.autograd.set_detect_anomaly(True)
+if os.environ.get('DEBUG_ANOMALY'):   # autograd anomaly detection slows every op down, so only turn it on for debugging
+    torch.autograd.set_detect_anomaly(True)
 
 def print_progress(i, numiter):
     """This function prints to the screen the optimisation progress (at each iteration i, out of a total of numiter iterations)."""
@@ -53,7 +56,7 @@ def print_progress(i, numiter):
 def batch_to_torch(originalimages):
     """Convert the input batch to a torch tensor"""
     #originalimages = originalimages.unsqueeze(1)   # change dim for the convnet
-    originalimages = originalimages.type(torch.FloatTensor)  # convert torch tensor data type
+    originalimages = originalimages.float()  # convert torch tensor data type (staying on the batch's device)
     return originalimages
 
 
@@ -62,17 +65,16 @@ def answer_correct(output, label):
     This function compares the output to the label on that trial (or batch) and
     determines whether it (or how many) match the target label.
     """
-    output = np.squeeze(output, axis=1)
-    pred = np.zeros((output.size()))
-    # print("output.size()", output.size())
-    for i in range((output.size()[0])):
-        if output[i]>0.5:
-            pred[i] = 1
-        else:
-            pred[i] = 0
-    tmp = np.squeeze(np.asarray(label))
-    # print('1 or 0: ',(pred==tmp).sum().item())
-    return (pred==tmp).sum().item()
+    pred = (output.squeeze(1) > 0).to(label.dtype)   # the output is a logit: 1 if it is above 0 (p > 0.5), otherwise 0
+    return (pred == label.reshape(-1)).sum().item()
+
+
+def add_hidden_noise(hidden, noise_std):
+    """Inject iid gaussian noise with standard deviation noise_std into the recurrent hidden state, drawn on its device.
+    With noise_std 0.0 (the setting in use) the hidden state is returned untouched and no noise is drawn."""
+    if noise_std > 0.0:
+        hidden = hidden + torch.randn_like(hidden) * noise_std
+    return hidden
 
 
 def plot_grad_flow(args, layers, ave_grads, max_grads, batch_number):
@@ -97,6 +99,37 @@ def plot_grad_flow(args, layers, ave_grads, max_grads, batch_number):
     #mplt.save_figure('figures/gradients/gradflow_{}_'.format(batch_number), args, 'recurrent', blockTrain, seqTrain, True, givenContext, False, noise_std, retainHiddenState, False, 'compare', True)
 
 
+def rollout(model, recurrentinputs, hidden, checkpoint=False):
+    """Pass a (batch, sequenceLength, input) sequence of recurrent inputs through the model one step at a time, starting from hidden.
+    Returns the outputs and hidden states of every step, stacked as (sequenceLength, batch, ...).
+    - checkpoint: keep only the hidden states between ~sqrt(sequenceLength) segments of steps for the backward pass,
+      and recompute the activations inside each segment during backward (less memory for a little more compute)
+    """
+    def run_segment(hidden, segment):
+        if rnn_sequence is not None:
+            return model.sequence(segment, hidden)
+        outputs, hiddens = [], []
+        for step in range(segment.shape[1]):
+            # inject some noise (Note: no longer in use, set model.hidden_noise to 0.0)
+            hidden = add_hidden_noise(hidden, model.hidden_noise)
+            output, hidden = model(segment[:,step], hidden)
+            outputs.append(output)
+            hiddens.append(hidden)
+        return torch.stack(outputs), torch.stack(hiddens)
+
+    if not (checkpoint and torch.is_grad_enabled()):
+        return run_segment(hidden, recurrentinputs)
+    sequenceLength = recurrentinputs.shape[1]
+    segmentLength = math.ceil(math.sqrt(sequenceLength))
+    outputs, hiddens = [], []
+    for start in range(0, sequenceLength, segmentLength):
+        segmentOutputs, segmentHiddens = torch.utils.checkpoint.checkpoint(run_segment, hidden, recurrentinputs[:,start:start+segmentLength], use_reentrant=False)
+        outputs.append(segmentOutputs)
+        hiddens.append(segmentHiddens)
+        hidden = segmentHiddens[-1]
+    return torch.cat(outputs), torch.cat(hiddens)
+
+
 def recurrent_train(args, model, device, train_loader, optimizer, criterion, epoch, printOutput=True):
     """ Train a recurrent neural network on the training set.
     This now trains whilst retaining the hidden state across all trials in the training sequence
@@ -112,66 +145,52 @@ def recurrent_train(args, model, device, train_loader, optimizer, criterion, epo
     all_trials_counter = 0
 
     # On the very first trial on training, reset the hidden weights to zeros
-    hidden = torch.zeros(args.batch_size, model.recurrent_size)
-    latentstate = torch.zeros(args.batch_size, model.recurrent_size)
+    zeroHidden = torch.zeros(args.batch_size, model.recurrent_size, device=device)  # allocated once: the hidden state is never written in place
+    hidden = zeroHidden
+    latentstate = zeroHidden
 
     for batch_idx, data in enumerate(train_loader):
-        optimizer.zero_grad()   # zero the parameter gradients
-        inputs, labels, contextsequence, trialtype = batch_to_torch(data['input']), data['label'].type(torch.FloatTensor)[0].unsqueeze(1).unsqueeze(1), batch_to_torch(data['contextinput']), batch_to_torch(data['trialtypeinput']).unsqueeze(2)
+        data = dset.batch_to_device(data, device)
+        optimizer.zero_grad(set_to_none=True)   # drop the parameter gradients, so backward writes fresh ones rather than zeroing them first
+        inputs, labels, contextsequence, trialtype = data['input'], data['label'][0].unsqueeze(1).unsqueeze(1), data['contextinput'], batch_to_torch(data['trialtypeinput']).unsqueeze(2)
 
         # initialise everything for our recurrent model
-        recurrentinputs = []
         sequenceLength = inputs.shape[1]
-        n_comparetrials = np.nansum(np.nansum(trialtype))
+        # the trials assessed (compare trials with a label), read back once per sequence rather than tested on the device per step
+        assessed = (~torch.isnan(labels[:,0,0]) & (trialtype[0,:,0] == 1)).tolist()
         layers, ave_grads, max_grads = [[] for i in range(3)]
-        lesionRecord = np.zeros((sequenceLength,))
         loss = 0
-        alternate_lesion_trial = True  # for retraining decoder, lesion alternate trials
-        
-        for i in range(sequenceLength):
-            context = contextsequence[:,i]
-            lesionedinput = inputs[:,i]
-            if trialtype[0,i]==0:  # remove context indicator on the filler trials
-                context_in = torch.full_like(context, 0)
-            else:
-                context_in = copy.deepcopy(context)
-                if args.retrain_decoder:
-                    if alternate_lesion_trial: # alternately lesion the number input on compare trials
-                        lesionRecord[i] = 1
-                        lesionedinput = torch.full_like(inputs[:,i],0)
-                else:
-                    if (random.random() < args.train_lesion_freq): # occasionally lesion the number input on compare trials
-                        lesionRecord[i] = 1
-                        lesionedinput = torch.full_like(inputs[:,i],0)
-
-            alternate_lesion_trial = False if alternate_lesion_trial else True
-            inputX = torch.cat((lesionedinput, context_in, trialtype[:,i]),1)
-            recurrentinputs.append(inputX)
+
+        # the whole (batch, sequenceLength, input) sequence of recurrent inputs comes pre-encoded, only the lesions are applied here
+        isCompare = trialtype[0,:,0] != 0
+        if args.retrain_decoder:  # for retraining decoder, alternately lesion the number input on compare trials
+            isLesioned = isCompare & (torch.arange(sequenceLength, device=isCompare.device) % 2 == 0)
+        else:                     # occasionally lesion the number input on compare trials
+            isLesioned = isCompare & torch.bernoulli(torch.full((sequenceLength,), float(args.train_lesion_freq), device=isCompare.device)).bool()
+        lesionRecord = isLesioned.cpu().numpy().astype(float)
+        lesionedinput = inputs * (~isLesioned).to(inputs.dtype)[None,:,None]
+        recurrentinputs = torch.cat((lesionedinput, data['recurrentinput'][:,:,inputs.shape[2]:]), 2)
 
         if not args.retain_hidden_state:
-            hidden = torch.zeros(args.batch_size, model.recurrent_size)  # only if you want to reset hidden recurrent weights
+            hidden = zeroHidden  # only if you want to reset hidden recurrent weights
         else:
             hidden = latentstate # keep hidden state to reflect recent statistics of previous inputs
 
         # perform N-steps of recurrence
+        with torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=args.amp):  # bfloat16 needs no gradient scaling
+            outputs, hiddens = rollout(model, recurrentinputs, hidden, args.checkpoint_rollout)
+        outputs, hiddens = outputs.float(), hiddens.float()   # the loss (BCEWithLogitsLoss) and the retained hidden state stay in float32
+        latentstate = hiddens[sequenceLength-2].detach()   # the hidden state just before the last input in the sequence is presented
         for item_idx in range(sequenceLength):
-            # inject some noise (Note: no longer in use, set model.hidden_noise to 0.0)
-            noise = torch.from_numpy(np.reshape(np.random.normal(0, model.hidden_noise, hidden.shape[0]*hidden.shape[1]), (hidden.shape)))
-            #print('hidden1', hidden)
-            hidden = hidden.add(noise) # ! .add_(noise) was there originally
-            #print('hidden2', hidden)
-            hidden = hidden.to(torch.float32) # turn into a float instead of double
-            output, hidden = model(recurrentinputs[item_idx], hidden)
-            if item_idx==(sequenceLength-2):                  # extract the hidden state just before the last input in the sequence is presented
-                latentstate = hidden.detach()
+            output = outputs[item_idx]
 
             # for 'compare' trials only, evaluate performance at every comparison between the current input and previous 'compare' input
             # if item_idx > 0 and (trialtype[0,item_idx]==1):
             # SN double check that trialtype is always 1?
             #     loss = loss + criterion(output, labels[item_idx])   # accumulate the loss (autograd should sort this out for us: https://pytorch.org/tutorials/intermediate/char_rnn_generation_tutorial.html)
             #     correct = correct + answer_correct(output, labels[item_idx])
-                
-            if np.isnan(labels[item_idx]) ==0  and (trialtype[0,item_idx]==1):
+            
+            if assessed[item_idx]:
                 loss = loss + criterion(output, labels[item_idx])   # accumulate the loss (autograd should sort this out for us: https://pytorch.org/tutorials/intermediate/char_rnn_generation_tutorial.html)
                 correct = correct + answer_correct(output, labels[item_idx])
                 trials_counter += 1
@@ -181,16 +200,19 @@ def recurrent_train(args, model, device, train_loader, optimizer, criterion, epo
         loss.backward()
 
         #print("step 2")
-        # record and visualise our gradients
-        if (batch_idx % 100) == 0:
+        # record and visualise our gradients (only needed for the gradient flow figure)
+        if args.log_gradients and (batch_idx % 100) == 0:
+            grads = []
             for n, p in model.named_parameters():
                 if(p.requires_grad) and ("bias" not in n):
                     if p.grad is not None:
                         layers.append(n)
-                        ave_grads.append(p.grad.abs().mean())
-                        max_grads.append(p.grad.abs().max())
+                        grads.append(p.grad)
                     else:
                         print("Warning: p.grad gradient is type None at batch {} in sequence of length {}".format(batch_idx, sequenceLength) )
+            for absgrad in torch._foreach_abs(grads):   # one fused abs over all the weight gradients
+                ave_grads.append(absgrad.mean())
+                max_grads.append(absgrad.max())
             plot_grad_flow(args, layers, ave_grads, max_grads, batch_idx)
 
         optimizer.step()            # update our weights
@@ -214,56 +236,56 @@ def recurrent_train(args, model, device, train_loader, optimizer, criterion, epo
     return train_loss, accuracy
 
 
-def recurrent_test(args, model, device, test_loader, criterion, trials_file_path, testing_set, printOutput=True, ):
-    """Test a recurrent neural network on the test set (without lesions)."""
+def recurrent_test(args, model, device, test_loader, criterion, trials_file_path, testing_set, printOutput=True, trial_files=None):
+    """Test a recurrent neural network on the test set (without lesions).
+    - the trials are appended to the testing_set record file: trial_files[testing_set] if given an already open file, else the file at trials_file_path
+    """
     model.eval()
     test_loss = 0
     correct = 0
     trials_counter = 0
 
     # reset hidden recurrent weights on the very first trial
-    hidden = torch.zeros(args.batch_size, model.recurrent_size)
-    latentstate = torch.zeros(args.batch_size, model.recurrent_size)
+    zeroHidden = torch.zeros(args.batch_size, model.recurrent_size, device=device)  # allocated once: the hidden state is never written in place
+    hidden = zeroHidden
+    latentstate = zeroHidden
     
     # testing_set determines the text file the trails will be written to
     # testing_set = 'test' or 'train'
-    trials_file_path = const.TRIALS_DIRECTORY + testing_set + "_" + trials_file_path
+    trials_file_path = const.TRIALS_DIRECTORY / (testing_set + "_" + trials_file_path)
+    trial_log = []
 
-    with torch.no_grad():  # dont track the gradients
+    with torch.inference_mode():  # dont track the gradients (nor tensor versions and views)
         for batch_idx, data in enumerate(test_loader):
-            inputs, labels, contextsequence, trialtype = batch_to_torch(data['input']), data['label'].type(torch.FloatTensor)[0].unsqueeze(1).unsqueeze(1), batch_to_torch(data['contextinput']), batch_to_torch(data['trialtypeinput']).unsqueeze(2)
+            data = dset.batch_to_device(data, device)
+            inputs, labels, contextsequence, trialtype = data['input'], data['label'][0].unsqueeze(1).unsqueeze(1), data['contextinput'], batch_to_torch(data['trialtypeinput']).unsqueeze(2)
 
-            # reformat the input sequences for our recurrent model
-            recurrentinputs = []
+            # the input sequences for our recurrent model, pre-encoded as one (batch, sequenceLength, input) tensor
             sequenceLength = inputs.shape[1]
-            n_comparetrials = np.nansum(np.nansum(trialtype))
-
-            for i in range(sequenceLength):
-                context = contextsequence[:,i]
-                if trialtype[0,i]==0:  # remove context indicator on the filler trials
-                    context_in = torch.full_like(context, 0)
-                else:
-                    context_in = copy.deepcopy(context)
-                inputX = torch.cat((inputs[:, i], context_in, trialtype[:,i]),1)
-                recurrentinputs.append(inputX)
+            n_comparetrials = int(torch.nansum(trialtype))
+            recurrentinputs = data['recurrentinput']
+            # the trials assessed (compare trials with a label) and their labels, read back once per sequence
+            assessed = (~torch.isnan(labels[:,0,0]) & (trialtype[0,:,0] == 1)).tolist()
+            labelValues = labels[:,0,0].tolist()
+            # the judgement value of every trial in the sequence, read off the one-hot number input in one go
+            numberinputs = recurrentinputs[0, :, :const.TOTALMAXNUM]
+            judgeValues = (numberinputs.argmax(dim=1) + 1).tolist()  # add 1 to get the actual value instead of index
+            multipleJudgements = ((numberinputs == 1).sum(dim=1) > 1).tolist()
 
             if not args.retain_hidden_state:  # only if you want to reset hidden state between trials
-                hidden = torch.zeros(args.batch_size, model.recurrent_size)
+                hidden = zeroHidden
             else:
                 hidden = latentstate
 
-            # perform a N-step recurrence for the whole sequence of numbers in the input
+            # perform a N-step recurrence for the whole sequence of numbers in the input, then go through its outputs
+            outputs, hiddens = rollout(model, recurrentinputs, hidden)
+            latentstate = hiddens[sequenceLength-2]   # the hidden state just before the last input in the sequence is presented
+            guesses = (outputs[:,0,0] > 0).tolist()   # logit above 0, i.e. p > 0.5
             ref_Value = np.nan
             for item_idx in range(sequenceLength):
+                output = outputs[item_idx]
 
-                # inject some noise (Note: no longer in use, set model.hidden_noise to 0.0)
-                noise = torch.from_numpy(np.reshape(np.random.normal(0, model.hidden_noise, hidden.shape[0]*hidden.shape[1]), (hidden.shape)))
-                hidden.add_(noise)
-                output, hidden = model(recurrentinputs[item_idx], hidden)
-                if item_idx==(sequenceLength-2):  # extract the hidden state just before the last input in the sequence is presented
-                    latentstate = hidden.detach()
-
-                if np.isnan(labels[item_idx]) ==0  and (trialtype[0,item_idx]==1):
+                if assessed[item_idx]:
                     test_loss += criterion(output, labels[item_idx]).item()
                     answer = answer_correct(output, labels[item_idx])
                     correct += answer
@@ -271,22 +293,13 @@ def recurrent_test(args, model, device, test_loader, criterion, trials_file_path
                     
                     # if answer_correct(output, labels[item_idx]) == 0:
                     #     print('inputs: ', inputs[item_idx])
-                    # print("recurrentinputs: ", recurrentinputs[item_idx])
-                    first_eight = recurrentinputs[item_idx][0, :const.TOTALMAXNUM] # gets the first set of elements which is the range
-                    #Find indices where values are 1
-                    indices_of_ones = (first_eight == 1).nonzero(as_tuple=True)[0]
-                    # Convert indices to a list for easier viewing
-                    indices_list = indices_of_ones.tolist()
-                    if len(indices_list) > 1:
+                    # print("recurrentinputs: ", recurrentinputs[:,item_idx])
+                    if multipleJudgements[item_idx]:
                         print("Warning: more than one chosen judgement value")
-                    judge_value = indices_list[0] + 1 # add 1 to get the actual value instead of index
-                    
-                    if np.squeeze(output) > 0.5:
-                        model_guess = 1
-                    else:
-                        model_guess = 0
+                    judge_value = judgeValues[item_idx]
                     
-                    label = np.squeeze(labels[item_idx])
+                    model_guess = int(guesses[item_idx])
+                    label = labelValues[item_idx]
 
                     # print(f"judge_value: {judge_value}")
                     # print(f"ref_Value: {ref_Value}")
@@ -297,20 +310,12 @@ def recurrent_test(args, model, device, test_loader, criterion, trials_file_path
                     # print(f"guess: {model_guess}")
                     # print(f"label: {np.squeeze(labels[item_idx])}\n")
                     
-                    # format in a single line
+                    # format in a single line, collected for the txt file (written once after the whole test set)
                     trial = f"judge_value: {judge_value}\t ref_Value: {ref_Value}\t model_guess: {model_guess}\t dataset_label: {label}\t answer_correct: {answer}\n"
-                    print(trial)
+                    trial_log.append(trial)
                     if (model_guess != label and answer == 1) or (model_guess == label and answer == 0):
-                        print("Misclassified")
-                        
-                    # append info to txt file
-                    with open(trials_file_path, 'a') as file:
-                        file.write(trial)
-                        if (model_guess != label and answer == 1) or (model_guess == label and answer == 0):
-                            file.write("Misclassified\n")
-
-                        
-                    
+                        trial_log.append("Misclassified\n")
+
                     ref_Value = judge_value
 
                     trials_counter += 1
@@ -321,8 +326,12 @@ def recurrent_test(args, model, device, test_loader, criterion, trials_file_path
 
     test_loss /= trials_counter  # there are n_comparetrials-1 instances of feedback per sequence
     accuracy = 100. * correct / trials_counter
-    with open(trials_file_path, 'a') as file:
-        file.write(f"Accuracy: {accuracy}\n")
+    trial_log.append(f"Accuracy: {accuracy}\n")
+    if trial_files is not None:
+        trial_files[testing_set].writelines(trial_log)
+    else:
+        with open(trials_file_path, 'a') as file:   # append info to txt file
+            file.writelines(trial_log)
     
     if printOutput:
         print('\nTest set: Average loss: {:.4f}, Accuracy: {}/{} ({:.0f}%)\n'.format(test_loss, correct, len(test_loader.dataset)*(n_comparetrials-1), accuracy))
@@ -356,82 +365,76 @@ def recurrent_lesion_test(args, model, device, test_loader, criterion, printOutp
     model.eval()
 
     # reset hidden recurrent weights on the very first trial
-    hidden = torch.zeros(args.batch_size, model.recurrent_size)
-    latentstate = torch.zeros(args.batch_size, model.recurrent_size)
+    zeroHidden = torch.zeros(args.batch_size, model.recurrent_size, device=device)  # allocated once: the hidden state is never written in place
+    hidden = zeroHidden
+    latentstate = zeroHidden
     n_sequences = 0
     overallcomparisons = 0
     aggregateLesionPerf = 0
     aggregatePerf = 0
     allLesionAssessments = []
 
-    with torch.no_grad():  # dont track the gradients
+    with torch.inference_mode():  # dont track the gradients (nor tensor versions and views)
         # for each sequence
         for batch_idx, data in enumerate(test_loader):
-            inputs, labels, contextsequence, contextinputsequence, trialtype = batch_to_torch(data['input']), data['label'].type(torch.FloatTensor)[0].unsqueeze(1).unsqueeze(1), batch_to_torch(data['context']), batch_to_torch(data['contextinput']), batch_to_torch(data['trialtypeinput']).unsqueeze(2)
+            data = dset.batch_to_device(data, device)
+            inputs, labels, contextsequence, contextinputsequence, trialtype = data['input'], data['label'][0].unsqueeze(1).unsqueeze(1), data['context'], data['contextinput'], batch_to_torch(data['trialtypeinput']).unsqueeze(2)
             # setup
-            recurrentinputs = []
             sequenceLength = inputs.shape[1]
             sequenceAssessment = []
 
-            # organise the inputs for each trial in our sequence
-            for i in range(sequenceLength):
-                context = contextinputsequence[:,i]
+            # the inputs for each trial in our sequence, pre-encoded as one (batch, sequenceLength, input) tensor
+            isCompare = trialtype[0,:,0] != 0
+            compareTrials = isCompare.cpu().numpy()
+            recurrentinputs = data['recurrentinput']
+            lesionedSlice = slice(0, const.TOTALMAXNUM) if whichLesion=='number' else slice(const.TOTALMAXNUM, const.TOTALMAXNUM+const.NCONTEXTS)
 
-                if trialtype[0,i]==0:
-                    inputcontext = torch.full_like(context, 0)  # all filler trials should have no context input to it
-                else:
-                    inputcontext = copy.deepcopy(context)
-                inputX = torch.cat((inputs[:, i], inputcontext, trialtype[:, i]),dim=1)
-                recurrentinputs.append(inputX)
+            # each time we repeat this exercise we need to use the original hidden state from previous sequence
+            if not args.retain_hidden_state:  # only if you want to reset hidden state between trials
+                startHidden = zeroHidden
+            else:
+                startHidden = latentstate
+            # every assessment runs the unlesioned sequence up to its first lesion, so run the unlesioned sequence once and
+            # restart each assessment from the hidden state just before its first lesioned trial
+            prefixOutputs, prefixHiddens = rollout(model, recurrentinputs, startHidden)
 
             # consider each number in the sequence
             for assess_idx in range(sequenceLength):
                 lesionRecord = np.zeros((sequenceLength,))  # reset out lesion record
-                context = dset.turn_one_hot_to_integer(contextsequence[:,assess_idx][0])[0]  # the true underlying context for this input
-
-                # each time we repeat this exercise we need to use the original hidden state from previous sequence
-                if not args.retain_hidden_state:  # only if you want to reset hidden state between trials
-                    hidden = torch.zeros(args.batch_size, model.recurrent_size)
-                else:
-                    hidden = latentstate
+                context = dset.turn_one_hot_to_integer(contextsequence[:,assess_idx][0].cpu())[0]  # the true underlying context for this input
+                hidden = startHidden
 
                 # if its a comparison trial, we will use it to assess performance and lesion our sequence up to this point
                 if (trialtype[:,assess_idx]==1) and (assess_idx>0):  # don't use the very first trial as an assessment trial
                     # Look backwards from the assessment point, lesion the immediately previous compare trial,
                     # and then every prior compare trial with frequency F
-                    isPrevCompareTrial = True
-                    for item_idx in range(assess_idx-1,-1,-1):
-                         # lesion the compare trial immediately preceeding the assessment trial
-                        if (trialtype[:,item_idx]==1) and isPrevCompareTrial:
-                            lesionRecord[item_idx] = 1
-                            isPrevCompareTrial = False
-                        else:
-                            # now lesion each other compare trial with frequency F
-                            if (trialtype[:,item_idx]==1):
-                                if (random.random() < lesionFrequency):
-                                    lesionRecord[item_idx] = 1
+                    prevCompares = np.flatnonzero(compareTrials[:assess_idx])
+                    # now lesion each other compare trial with frequency F
+                    lesionRecord[prevCompares] = torch.bernoulli(torch.full((len(prevCompares),), float(lesionFrequency))).numpy()
+                    # lesion the compare trial immediately preceeding the assessment trial
+                    lesionRecord[prevCompares[-1:]] = 1
 
                     # now that we have performed our lesions up to our assessment trial, pass this sequence through the network and assess performance
-                    assess_number = dset.turn_one_hot_to_integer(inputs[:,assess_idx][0])[0]
-                    tmpinputs = copy.deepcopy(recurrentinputs)
+                    assess_number = dset.turn_one_hot_to_integer(inputs[:,assess_idx][0].cpu())[0]
+                    # apply all the lesions at once to a copy of the sequence (only the first sample's inputs are lesioned, as before)
+                    lesioned = np.flatnonzero(lesionRecord)
+                    if len(lesioned) > 0:
+                        lesion_number = dset.turn_one_hot_to_integer(recurrentinputs[0, lesioned[-1], 0:const.TOTALMAXNUM].cpu())  # the lesion closest to the assessment trial
+                    tmpinputs = recurrentinputs.clone()
+                    tmpinputs[0, lesioned, lesionedSlice] = 0
                     overallperf = 0
                     ncomparetrials = 0
 
-                    for trial in range(assess_idx+1):
+                    firstLesion = lesioned[0] if len(lesioned) > 0 else assess_idx+1   # (no earlier compare trial to lesion)
 
-                        # if trial designated for lesioning, apply the lesion
-                        if lesionRecord[trial]==1:
-                            lesion_number = dset.turn_one_hot_to_integer(tmpinputs[trial][0][0:const.TOTALMAXNUM])
-                            if whichLesion=='number':
-                                tmpinputs[trial][0][0:const.TOTALMAXNUM] = torch.full_like(tmpinputs[trial][0][0:const.TOTALMAXNUM], 0)
-                            else:
-                                tmpinputs[trial][0][const.TOTALMAXNUM:const.TOTALMAXNUM+const.NCONTEXTS] = torch.full_like(tmpinputs[trial][0][const.TOTALMAXNUM:const.TOTALMAXNUM+const.NCONTEXTS], 0)
+                    for trial in range(assess_idx+1):
 
-                        # inject some noise (Note: no longer in use, set model.hidden_noise to 0.0)
-                        noise = torch.from_numpy(np.reshape(np.random.normal(0, model.hidden_noise, hidden.shape[0]*hidden.shape[1]), (hidden.shape)))
-                        hidden.add_(noise)
-                        output, hidden = model(tmpinputs[trial], hidden)
-                        h0activations, h1activations, _ = model.get_activations(tmpinputs[trial], hidden)
+                        if trial < firstLesion:   # no lesions yet: reuse the unlesioned pass
+                            output, hidden = prefixOutputs[trial], prefixHiddens[trial]
+                        else:
+                            # inject some noise (Note: no longer in use, set model.hidden_noise to 0.0)
+                            hidden = add_hidden_noise(hidden, model.hidden_noise)
+                            output, hidden = model(tmpinputs[:,trial], hidden)
 
                         # assess aggregate performance on whole sequence (including all lesions)
                         if trialtype[:,trial]==1:
@@ -441,7 +444,8 @@ def recurrent_lesion_test(args, model, device, test_loader, criterion, printOutp
                             # once we get to the assessment trial, assess performance
                             if trial==assess_idx:
                                 lesionperf = answer_correct(output, labels[trial])
-                                post_lesion_activations = h1activations
+                                h0activations, h1activations, _ = model.get_activations(tmpinputs[:,trial], hidden)
+                                post_lesion_activations = h1activations.cpu()   # (kept with the lesion records for analysis in numpy)
 
                     localmodel_perf = get_local_model_response(assess_number, context, labels[trial])   # correct or incorrect
                     globalmodel_perf = get_global_model_response(assess_number, context, labels[trial]) # correct or incorrect
@@ -458,9 +462,8 @@ def recurrent_lesion_test(args, model, device, test_loader, criterion, printOutp
                 # since the network has only processed sequences up to compare trials, we need to pass the whole sequence through again now! inefficient, yes
                 if assess_idx==(sequenceLength-2):
                     for i in range(assess_idx+1):
-                        noise = torch.from_numpy(np.reshape(np.random.normal(0, model.hidden_noise, hidden.shape[0]*hidden.shape[1]), (hidden.shape)))
-                        hidden.add_(noise)
-                        output, hidden = model(tmpinputs[i], hidden)  # this should be the sequence of trials that are all lesioned with probability F
+                        hidden = add_hidden_noise(hidden, model.hidden_noise)
+                        output, hidden = model(tmpinputs[:,i], hidden)  # this should be the sequence of trials that are all lesioned with probability F
                     latentstate = hidden.detach()
 
             allLesionAssessments.append(sequenceAssessment)
@@ -476,12 +479,8 @@ def recurrent_lesion_test(args, model, device, test_loader, criterion, printOutp
 
 
 def sort_all_vars_by_x(allvars, sortind):
-    """This function sort_all_vars_by_x() will sort all variables input in allvars according to the indices of sortind."""
-    sortedvars = []
-    for thisvar in allvars:
-        thisvar = np.take_along_axis(thisvar, sortind, axis=0)
-        sortedvars.append(thisvar)
-    return sortedvars
+    """This function sort_all_vars_by_x() will sort all variables input in allvars according to the (1D) row indices of sortind."""
+    return [thisvar[sortind] for thisvar in allvars]   # one row gather per variable
 
 
 def sort_activations(allvars):
@@ -491,48 +490,46 @@ def sort_activations(allvars):
     contexts, activations, MDSlabels, labels_refValues, labels_judgeValues, time_index, counter = allvars
 
     # sort all variables first by context order
-    context_ind = np.argsort(contexts, axis=0)
+    context_ind = np.argsort(contexts[:,0])
     contexts, activations, MDSlabels, labels_refValues, labels_judgeValues, time_index, counter = sort_all_vars_by_x(allvars, context_ind)
 
-    # within each context, sort according to numerosity of the judgement value
-    for context in range(1,const.NCONTEXTS+1):
-        ind = [i for i in range(contexts.shape[0]) if contexts[i]==context]
-        numerosity_ind = np.argsort(labels_judgeValues[ind], axis=0) + ind[0]
-        allvars = [contexts, activations, MDSlabels, labels_refValues, labels_judgeValues, time_index, counter] # important that this is updated in loop
-        contexts[ind], activations[ind], MDSlabels[ind], labels_refValues[ind], labels_judgeValues[ind], time_index[ind], counter[ind] = sort_all_vars_by_x(allvars, numerosity_ind)
+    # within each context, sort according to numerosity of the judgement value:
+    # the contexts are now sorted, so each context is one contiguous block of rows which can be sorted in place
+    allvars = [contexts, activations, MDSlabels, labels_refValues, labels_judgeValues, time_index, counter]
+    _, starts = np.unique(contexts[:,0], return_index=True)
+    bounds = np.append(starts, contexts.shape[0])
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        numerosity_ind = np.argsort(labels_judgeValues[start:end,0])
+        for thisvar in allvars:
+            thisvar[start:end] = thisvar[start:end][numerosity_ind]
 
     return contexts, activations, MDSlabels, labels_refValues, labels_judgeValues, time_index, counter
 
 
 def format_input_sequence(TRIAL_TYPE, testset):
-    """ *This function is obsolete*
-    This function format_input_sequence() is for tidying up get_activations(),
-    and will determine the unique inputs in the test set (there will be repeats in the original test set).
+    """This function format_input_sequence() is for tidying up get_activations(),
+    and will build the (input, [previous input,] context) row of every trial of type TRIAL_TYPE in the test set, as one 2D array
+    (there will be repeats in the original test set). Each compare trial is paired with the previous compare trial in its sequence.
+     - the rows are concatenated one-hots (0s and 1s), so they are stored as int8 for compact hashing and comparison
     """
-    testset_input_n_context, seq_record = [[] for i in range(2)]
-    for seq in range(len(testset["input"])):
-        inputA, inputB = [None for i in range(2)]
-        for item_idx in range(len(testset["input"][seq])):
-            trialtype = testset["trialtypeinputs"][seq, item_idx]
-
-            if TRIAL_TYPE==const.TRIAL_COMPARE:
-                if trialtype==TRIAL_TYPE:
-                    inputA = testset["input"][seq, item_idx]
-                    if inputB is not None:
-                        if np.all(inputA==inputB):
-                            print('Warning: adjacent trial types are same number {}, both of type compare at item {} in sequence {}'.format(dset.turn_one_hot_to_integer(inputA)[:], item_idx,seq))
-                        context = testset["context"][seq, item_idx]  # the actual underlying range context, not the label
-                        testset_input_n_context.append(np.append(np.append(inputA, inputB), context))
-                        seq_record.append([seq, item_idx])
-
-                    inputB = testset["input"][seq, item_idx]  # set the previous state to be the current state
-
-            elif TRIAL_TYPE==const.TRIAL_FILLER:
-                if trialtype==TRIAL_TYPE:
-                    inputA = testset["input"][seq, item_idx]
-                    context = testset["context"][seq, item_idx]  # the actual underlying range context, not the label
-                    testset_input_n_context.append(np.append(inputA, context))
-                    seq_record.append([seq, item_idx])
+    seq_record = np.argwhere(testset["trialtypeinputs"] == TRIAL_TYPE)   # every trial of this type, in sequence order
+    seqs, items = seq_record[:,0], seq_record[:,1]
+    inputA = testset["input"][seqs, items]
+    context = testset["context"][seqs, items]  # the actual underlying range context, not the label
+    if TRIAL_TYPE==const.TRIAL_COMPARE:
+        inputB = np.roll(inputA, 1, axis=0)   # the previous compare input
+        hasPrevious = np.zeros(len(seqs), dtype=bool)
+        hasPrevious[1:] = seqs[1:]==seqs[:-1]   # the first compare trial in each sequence has no previous input to compare to
+        for seq, item_idx in seq_record[hasPrevious & np.all(inputA==inputB, axis=1)]:
+            print('Warning: adjacent trial types are same number {}, both of type compare at item {} in sequence {}'.format(dset.turn_one_hot_to_integer(testset["input"][seq, item_idx])[:], item_idx,seq))
+        seq_record, inputA, inputB, context = seq_record[hasPrevious], inputA[hasPrevious], inputB[hasPrevious], context[hasPrevious]
+        testset_input_n_context = np.empty((len(seq_record), 2*const.TOTALMAXNUM + const.NCONTEXTS), dtype=np.int8)
+        testset_input_n_context[:, :const.TOTALMAXNUM] = inputA
+        testset_input_n_context[:, const.TOTALMAXNUM:2*const.TOTALMAXNUM] = inputB
+    else:
+        testset_input_n_context = np.empty((len(seq_record), const.TOTALMAXNUM + const.NCONTEXTS), dtype=np.int8)
+        testset_input_n_context[:, :const.TOTALMAXNUM] = inputA
+    testset_input_n_context[:, -const.NCONTEXTS:] = context
 
     return seq_record, testset_input_n_context
 
@@ -543,12 +540,7 @@ def flatten_lists_to_arrays(testset, sequence_id, seqitem_id, allvarkeys):
      and creates a list of squashed arrays from the elements accessed by those keys at particular
      indices we care about (sequence_id, seqitem_id). For tidying up get_activations()
     """
-    arrayvars = []
-    for key in allvarkeys:
-        thisvar = np.asarray([testset[key][sequence_id[i]][seqitem_id[i]] for i in range(len(sequence_id))])
-        arrayvars.append(thisvar)
-
-    return arrayvars
+    return [testset[key][sequence_id, seqitem_id] for key in allvarkeys]   # one fancy-index gather per key
 
 
 def get_activations(args, trainset,trained_model, train_loader, whichType='compare'):
@@ -560,61 +552,37 @@ def get_activations(args, trainset,trained_model, train_loader, whichType='compa
      activation over all instances of the pair in the training set.
       - messy but functional.
     """
-    # reformat the input sequences for our recurrent model
-    recurrentinputs = []
-    sequenceLength = trainset["input"].shape[1]
+    sequenceLength = trainset["input"].shape[1]   # every sequence in the set has the same length
     TRIAL_TYPE = const.TRIAL_COMPARE if whichType=='compare' else const.TRIAL_FILLER
+    # the input, previous input and context of each (input, previous input, context) row from format_input_sequence
+    Arange = slice(0, const.TOTALMAXNUM)
+    Brange = slice(const.TOTALMAXNUM, 2*const.TOTALMAXNUM)
+    contextrange = slice(2*const.TOTALMAXNUM, None)
     print("TRIAL_TYPE", TRIAL_TYPE)
 
     # determine the unique inputs for the training set (there are repeats)
     # consider activations at all instances, then average these activations to get the mean per unique input.
-    trainset_input_n_context, seq_record = [[] for i in range(2)]
-    for seq in range(len(trainset["input"])):
-
-        inputA, inputB = [None for i in range(2)]
-        for item_idx in range(len(trainset["input"][seq])):
-            trialtype = trainset["trialtypeinputs"][seq, item_idx]
-
-            if TRIAL_TYPE==const.TRIAL_COMPARE:
-                if trialtype==TRIAL_TYPE:
-                    inputA = trainset["input"][seq, item_idx]
-                    if inputB is not None:
-                        if np.all(inputA==inputB):
-                            print('Warning: adjacent trial types are same number {}, both of type compare at item {} in sequence {}'.format(dset.turn_one_hot_to_integer(inputA)[:], item_idx,seq))
-                        context = trainset["context"][seq, item_idx]  # the actual underlying range context, not the label
-                        trainset_input_n_context.append(np.append(np.append(inputA, inputB), context))
-                        seq_record.append([seq, item_idx])
-
-                    inputB = trainset["input"][seq, item_idx]  # set the previous state to be the current state
-
-            elif TRIAL_TYPE==const.TRIAL_FILLER:
-                if trialtype==TRIAL_TYPE:
-                    inputA = trainset["input"][seq, item_idx]
-                    context = trainset["context"][seq, item_idx]  # the actual underlying range context, not the label
-                    trainset_input_n_context.append(np.append(inputA, context))
-                    seq_record.append([seq, item_idx])
-
+    seq_record, trainset_input_n_context = format_input_sequence(TRIAL_TYPE, trainset)
 
     #trainset_input_n_context = [np.append(trainset["input"][i, j],trainset["contextinput"][i]) for i in range(len(trainset["input"]))]  # ignore the context label, but consider the true underlying context
-    unique_inputs_n_context, uniqueind = np.unique(trainset_input_n_context, axis=0, return_index=True)
+    # deduplicate the rows by hashing their bytes (keeping first occurrences, in order) rather than lexsorting the whole array
+    firstOccurrence = {}
+    for i, row in enumerate(trainset_input_n_context):
+        firstOccurrence.setdefault(row.tobytes(), i)
+    uniqueind = np.fromiter(firstOccurrence.values(), dtype=np.int64, count=len(firstOccurrence))
+    unique_inputs_n_context = trainset_input_n_context[uniqueind]
+    uniqueLookup = {key: i for i, key in enumerate(firstOccurrence)}   # the bytes of each unique row -> its index in unique_inputs_n_context
     # print("unique_inputs_n_context", unique_inputs_n_context.shape)
     # print("uniqueind", uniqueind)
     N_unique = (unique_inputs_n_context.shape)[0]
-    sequence_id = [seq_record[uniqueind[i]][0] for i in range(len(uniqueind))]
-    seqitem_id = [seq_record[uniqueind[i]][1] for i in range(len(uniqueind))]
+    sequence_id, seqitem_id = seq_record[uniqueind,0], seq_record[uniqueind,1]
     num_unique = len(uniqueind)
     trainsize = trainset["label"].shape[0]
 
-    unique_inputs = np.asarray([trainset["input"][sequence_id[i]][seqitem_id[i]] for i in range(len(sequence_id))])
-    unique_labels = np.asarray([trainset["label"][sequence_id[i]][seqitem_id[i]] for i in range(len(sequence_id))])
-    unique_context = np.asarray([trainset["context"][sequence_id[i]][seqitem_id[i]] for i in range(len(sequence_id))])
-    unique_refValue = np.asarray([trainset["refValue"][sequence_id[i]][seqitem_id[i]] for i in range(len(sequence_id))])
-    unique_judgementValue = np.asarray([trainset["judgementValue"][sequence_id[i]][seqitem_id[i]] for i in range(len(sequence_id))])
+    # the integer digits fields hold the decoded one-hots, so the labels need no decoding here
+    unique_inputs, unique_labels, unique_contextdigits, unique_refdigits, unique_judgementdigits = flatten_lists_to_arrays(trainset, sequence_id, seqitem_id, ["input", "label", "contextdigits", "refdigits", "judgementdigits"])
     # print("unique_inputs", unique_inputs.shape)
     # print("unique_labels", unique_labels.shape)
-    # print("unique_context", unique_context.shape)
-    # print("unique_refValue", unique_refValue.shape)
-    # print("unique_judgementValue", unique_judgementValue.shape)
 
     # preallocate some space...
     labels_refValues = np.empty((len(uniqueind),1))
@@ -634,36 +602,40 @@ def get_activations(args, trainset,trained_model, train_loader, whichType='compa
     aggregate_activations = np.zeros((len(uniqueind), hdim))  # for adding each instance of activations to
     counter = np.zeros((len(uniqueind),1)) # for counting how many instances of each unique input/context we find
 
+    # label every unique input in one go
+    labels_refValues[:] = unique_refdigits[:,None]
+    labels_judgeValues[:] = unique_judgementdigits[:,None]
+    MDSlabels[:] = unique_labels.reshape(-1,1)
+    contexts[:] = unique_contextdigits[:,None]
+
     #  pass each input through the network and see what happens to the hidden layer activations
     if not ((args.network_style=='recurrent') and args.retain_hidden_state):
         print("(args.network_style=='recurrent') and args.retain_hidden_state")
-        for sample in range(len(uniqueind)):
-            sample_input = batch_to_torch(torch.from_numpy(unique_inputs[sample]))
-            sample_label = unique_labels[sample]
-            labels_refValues[sample] = dset.turn_one_hot_to_integer(unique_refValue[sample])
-            labels_judgeValues[sample] = dset.turn_one_hot_to_integer(unique_judgementValue[sample])
-            MDSlabels[sample] = sample_label
-            contexts[sample] = dset.turn_one_hot_to_integer(unique_context[sample])
-            time_index[sample] = 0  # doesnt mean anything for these not-sequential cases
-            counter[sample] = 0     # we dont care how many instances of each unique input for these non-sequential cases
-
-            # get the activations for that input
+        time_index[:] = 0  # doesnt mean anything for these not-sequential cases
+        counter[:] = 0     # we dont care how many instances of each unique input for these non-sequential cases
+
+        # get the activations for all the unique inputs as one batch
+        with torch.inference_mode():
             if args.network_style=='mlp':
-                h1activations,h2activations,_ = trained_model.get_activations(sample_input)
+                sample_inputs = batch_to_torch(torch.from_numpy(unique_inputs))
+                h1activations,h2activations,_ = trained_model.get_activations(sample_inputs)
             elif args.network_style=='recurrent':
-                if not args.retain_hidden_state:
-                    # reformat the paired input so that it works for our recurrent model
-                    context = sample_input[contextrange]
-                    inputA = (torch.cat((sample_input[Arange], context),0)).unsqueeze(0)
-                    inputB = (torch.cat((sample_input[Brange], context),0)).unsqueeze(0)
-                    recurrentinputs = [inputA, inputB]
-                    h0activations = torch.zeros(1,trained_model.recurrent_size)  # reset hidden recurrent weights
-
-                    # pass inputs through the recurrent network
-                    for i in range(2):
-                        h0activations,h1activations,_ = trained_model.get_activations(recurrentinputs[i], h0activations)
-
-                    activations[sample] = h1activations.detach()
+                # reformat the paired rows so that they work for our recurrent model: each input of the pair is presented
+                # as a compare trial, [number one-hot, context one-hot, trial type]
+                sample_inputs = batch_to_torch(torch.from_numpy(unique_inputs_n_context))
+                context = torch.cat((sample_inputs[:, contextrange], torch.full((num_unique, const.NTYPEBITS), float(const.TRIAL_COMPARE))),1)
+                inputA = torch.cat((sample_inputs[:, Arange], context),1)
+                inputB = torch.cat((sample_inputs[:, Brange], context),1)
+                # many unique pairs share their first input and context, so run the first step once per distinct first input
+                # and start each pair's second step from that shared hidden state
+                firstinputs, firstind = torch.unique(inputA, dim=0, return_inverse=True)
+                h0activations = torch.zeros(len(firstinputs), trained_model.recurrent_size)  # reset hidden recurrent weights
+
+                # pass inputs through the recurrent network
+                h0activations,_,_ = trained_model.get_activations(firstinputs, h0activations)
+                h0activations,h1activations,_ = trained_model.get_activations(inputB, h0activations[firstind])
+
+                activations[:] = h1activations.numpy()
 
     else:
         # Do a single pass through the whole training set and look out for ALL instances of each unique input.
@@ -672,127 +644,116 @@ def get_activations(args, trainset,trained_model, train_loader, whichType='compa
         h0activations = torch.zeros(1, trained_model.recurrent_size)
         latentstate = torch.zeros(1, trained_model.recurrent_size)
 
-        for batch_idx, data in enumerate(train_loader):
-            inputs, labels, contextsequence, contextinputsequence, trialtype = batch_to_torch(data['input']), data['label'].type(torch.FloatTensor)[0].unsqueeze(1).unsqueeze(1), batch_to_torch(data['context']), batch_to_torch(data['contextinput']), batch_to_torch(data['trialtypeinput']).unsqueeze(2)
-            recurrentinputs = []
-            sequenceLength = inputs.shape[1]
-            temporal_trialtypes[batch_idx] = data['trialtypeinput']
-
-            for i in range(sequenceLength):
-                temporal_context[batch_idx, i] = dset.turn_one_hot_to_integer(contextinputsequence[:,i][0])
-                contextin = contextinputsequence[:,i]
-                if trialtype[0,i]==0:  # remove context indicator on the filler trials
-                    contextinput = torch.full_like(contextin, 0)
-                else:
-                    contextinput = copy.deepcopy(contextin)
-
-                inputX = torch.cat((inputs[:, i], contextinput, trialtype[:,i]),1)
-                recurrentinputs.append(inputX)
-
-            h0activations = latentstate
-            inputA, inputB = [None for i in range(2)]
-
-            # perform N-steps of recurrence
-            for item_idx in range(sequenceLength):
-                h0activations,h1activations,_ = trained_model.get_activations(recurrentinputs[item_idx], h0activations)
-                if item_idx==(sequenceLength-2):  # extract the hidden state just before the last input in the sequence is presented
-                    latentstate = h0activations.detach()
-
-                temporal_activation_drift[batch_idx, item_idx,:] = h0activations.detach()   # Note: not currently used
-                context = contextsequence[:,item_idx]
-
-                # for 'compare' trials only, evaluate performance at every comparison between the current input and previous 'compare' input
-                if trialtype[0,item_idx] == TRIAL_TYPE:
+        with torch.inference_mode():  # dont track the gradients (nor tensor versions and views)
+            for batch_idx, data in enumerate(train_loader):
+                inputs, labels, contextsequence, contextinputsequence, trialtype = data['input'], data['label'][0].unsqueeze(1).unsqueeze(1), data['context'], data['contextinput'], batch_to_torch(data['trialtypeinput']).unsqueeze(2)
+                temporal_trialtypes[batch_idx] = data['trialtypeinput']
+
+                temporal_context[batch_idx] = dset.decode_one_hot_rows(contextinputsequence[0].numpy(), 0)  # the context label of every item in the sequence
+                recurrentinputs = data['recurrentinput']
+
+                h0activations = latentstate
+                inputA, inputB = [None for i in range(2)]
+                # the hidden state and fc1 activations at each step, copied out once per sequence
+                driftbuffer = torch.empty(sequenceLength, trained_model.recurrent_size)
+                fc1buffer = torch.empty(sequenceLength, hdim)
+                # sliced (and moved to numpy) once per sequence rather than at every step
+                numberinputs, truecontexts = recurrentinputs[0,:,:const.TOTALMAXNUM].numpy(), contextsequence[0].numpy()
+                isTrialType = (trialtype[0,:,0] == TRIAL_TYPE).tolist()
+
+                # perform N-steps of recurrence
+                for item_idx in range(sequenceLength):
+                    h0activations,h1activations,_ = trained_model.get_activations(recurrentinputs[:,item_idx], h0activations)
+                    if item_idx==(sequenceLength-2):  # extract the hidden state just before the last input in the sequence is presented
+                        latentstate = h0activations.detach()
+
+                    driftbuffer[item_idx] = h0activations[0]   # Note: not currently used
+                    fc1buffer[item_idx] = h1activations[0]
+                temporal_activation_drift[batch_idx] = driftbuffer.numpy()
+                fc1activations = fc1buffer.numpy()
+
+                # then record the activations of each trial of this type against its unique input
+                # (the labels of each unique input were set once above; only the activations and time index depend on the trial)
+                for item_idx in range(sequenceLength):
+                    if not isTrialType[item_idx]:
+                        continue
+                    inputA = numberinputs[item_idx]
                     if TRIAL_TYPE==const.TRIAL_COMPARE:    # if we are looking at act. for the compare trials only
-                        inputA = recurrentinputs[item_idx][0][:const.TOTALMAXNUM]
-                        if inputB is not None:
-                            input_n_context = np.append(np.append(inputA, inputB), context)  # actual underlying range context
-                            for i in range(N_unique):
-                                if np.all(unique_inputs_n_context[i,:]==input_n_context):
-                                    index = i
-                                    break
-
-                            activations[index] = h1activations.detach()
-                            labels_refValues[index] = dset.turn_one_hot_to_integer(unique_refValue[index])
-                            labels_judgeValues[index] = dset.turn_one_hot_to_integer(unique_judgementValue[index])
-                            MDSlabels[index] = unique_labels[index]
-                            contexts[index] = dset.turn_one_hot_to_integer(unique_context[index])
-                            time_index[index] = batch_idx
-                        inputB = recurrentinputs[item_idx][0][:const.TOTALMAXNUM]  # previous state <= current state
-
+                        # evaluate at every comparison between the current input and previous 'compare' input
+                        previous, inputB = inputB, inputA  # previous state <= current state
+                        if previous is None:
+                            continue
+                        input_n_context = np.concatenate((inputA, previous, truecontexts[item_idx]))  # actual underlying range context
                     else:  # for filler trials only, consider just the current number and context
-                        inputA = recurrentinputs[item_idx][0][:const.TOTALMAXNUM]
-                        input_n_context = np.append(inputA, context)  # actual underlying range context
-                        for i in range(N_unique):
-                            if np.all(unique_inputs_n_context[i,:]==input_n_context):
-                                index = i
-                                break
-                        activations[index] = h1activations.detach()
-                        labels_refValues[index] = dset.turn_one_hot_to_integer(unique_refValue[index])
-                        labels_judgeValues[index] = dset.turn_one_hot_to_integer(unique_judgementValue[index])
-                        MDSlabels[index] = unique_labels[index]
-                        contexts[index] = dset.turn_one_hot_to_integer(unique_context[index])
-                        time_index[index] = batch_idx
-
-                    if item_idx > 0:
-                        # Aggregate activity associated with each instance of each input
-                        aggregate_activations[index] += activations[index]
-                        counter[index] += 1    # captures how many instances of each unique input there are in the training set
+                        input_n_context = np.concatenate((inputA, truecontexts[item_idx]))  # actual underlying range context
+                    index = uniqueLookup[input_n_context.astype(unique_inputs_n_context.dtype).tobytes()]   # a single hashed lookup, rather than a scan over every unique row
+
+                    # Aggregate activity associated with each instance of each input
+                    aggregate_activations[index] += fc1activations[item_idx]
+                    counter[index] += 1    # captures how many instances of each unique input there are in the training set
+                    time_index[index] = batch_idx
 
         # Now turn the aggregate activations into mean activations by dividing by the number of each unique input/context instance
-        for i in range(counter.shape[0]):
-            if counter[i]==0:
-                counter[i]=1  # prevent divide by zero
-                print('Warning: index ' + str(i) + ' input had no instances?')
+        missing = np.flatnonzero(counter==0)
+        if missing.size:
+            print('Warning: indices ' + str(missing.tolist()) + ' input had no instances?')
+        counter = np.maximum(counter, 1)  # prevent divide by zero
 
         activations = np.divide(aggregate_activations, counter)
 
-    # Finally, reshape the output activations and labels so that we can easily interpret RSA on the activations
-    # print("2labels_judgeValues:", labels_judgeValues)
-    # sort all variables first by context order
-    context_ind = np.argsort(contexts, axis=0)
-    contexts = np.take_along_axis(contexts, context_ind, axis=0)
-    activations = np.take_along_axis(activations, context_ind, axis=0)
-    MDSlabels = np.take_along_axis(MDSlabels, context_ind, axis=0)
-    labels_refValues = np.take_along_axis(labels_refValues, context_ind, axis=0)
-    labels_judgeValues = np.take_along_axis(labels_judgeValues, context_ind, axis=0)
-    time_index = np.take_along_axis(time_index, context_ind, axis=0)
-    counter = np.take_along_axis(counter, context_ind, axis=0)
-    # print("1labels_judgeValues:", labels_judgeValues)
-
-    # within each context, sort according to numerosity of the judgement value
-    
-    for context in range(1,const.NCONTEXTS+1):
-        
-        # Initialize an empty list to store indices
-        ind = []
-        # Iterate over the range of the number of rows in the 'contexts' array
-        for i in range(contexts.shape[0]):
-            # Check if the element at index 'i' in 'contexts' is equal to 'context'
-            if contexts[i] == context:
-                # If the condition is met, append the index 'i' to the list 'ind'
-                ind.append(i)
-        # print("context:", context)
-        # print("ind:", ind)
-
-        # print("ind[0]:", ind[0])
-        # Since the values are exclusive to the context, only have to resort the values within the context
-        # so if ind is empty, the following lines will not have to be done.
-        # ! might have to chnage that only the ind[0] isnt called.
-        if ind != []:
-            numerosity_ind = np.argsort(labels_judgeValues[ind], axis=0) + ind[0]
-            labels_judgeValues[ind] = np.take_along_axis(labels_judgeValues, numerosity_ind, axis=0)
-            labels_refValues[ind] = np.take_along_axis(labels_refValues, numerosity_ind, axis=0)
-            contexts[ind] = np.take_along_axis(contexts, numerosity_ind, axis=0)
-            MDSlabels[ind] = np.take_along_axis(MDSlabels, numerosity_ind, axis=0)
-            activations[ind] = np.take_along_axis(activations, numerosity_ind, axis=0)
-            time_index[ind] = np.take_along_axis(time_index, numerosity_ind, axis=0)
-            counter[ind] = np.take_along_axis(counter, numerosity_ind, axis=0)
+    # Finally, reshape the output activations and labels so that we can easily interpret RSA on the activations:
+    # sort all variables first by context order, then by numerosity of the judgement value within each context
+    contexts, activations, MDSlabels, labels_refValues, labels_judgeValues, time_index, counter = sort_activations([contexts, activations, MDSlabels, labels_refValues, labels_judgeValues, time_index, counter])
 
     drift = {"temporal_activation_drift":temporal_activation_drift, "temporal_context":temporal_context}
     return activations, MDSlabels, labels_refValues, labels_judgeValues, contexts, time_index, counter, drift, temporal_trialtypes
 
 
+def one_step(x, hidden, input2both_weight, input2both_bias, fc1tooutput_weight, fc1tooutput_bias, recurrent_size: int):
+    """One step of OneStepRNN on its layer weights. Returns (output, hidden, fc1_activations).
+    The recurrent and fc1 layers both read the combined input, so they are computed as one matmul and split.
+    The output is a logit: the sigmoid is left to the loss (BCEWithLogitsLoss), apply torch.sigmoid for the probability."""
+    combined = torch.cat((x, hidden), 1)
+    both = F.relu(F.linear(combined, input2both_weight, input2both_bias))
+    hidden, fc1_activations = both[:, :recurrent_size], both[:, recurrent_size:]
+    output = F.linear(fc1_activations, fc1tooutput_weight, fc1tooutput_bias)
+    return output, hidden, fc1_activations
+
+
+def run_sequence(x_seq, hidden, input2both_weight, input2both_bias, fc1tooutput_weight, fc1tooutput_bias, recurrent_size: int, noise_std: float):
+    """Run one_step over every step of a (batch, sequenceLength, input) sequence, starting from hidden.
+    Returns the outputs and hidden states of every step, stacked as (sequenceLength, batch, ...)."""
+    outputs, hiddens = [], []
+    for t in range(x_seq.size(1)):
+        if noise_std > 0.0:
+            hidden = hidden + torch.randn_like(hidden) * noise_std
+        output, hidden, _ = one_step(x_seq[:, t], hidden, input2both_weight, input2both_bias, fc1tooutput_weight, fc1tooutput_bias, recurrent_size)
+        outputs.append(output)
+        hiddens.append(hidden)
+    return torch.stack(outputs), torch.stack(hiddens)
+
+
+# the step every OneStepRNN runs: scripted by default, so the matmuls and pointwise ops of each step run as one graph
+rnn_step = torch.jit.script(one_step)
+# the whole rollout loop scripted too, so a sequence costs one call from python rather than one per step (None under --compile)
+rnn_sequence = torch.jit.script(run_sequence)
+
+
+def use_compiled_step(device):
+    """Switch every OneStepRNN over to a torch.compile'd step (--compile), which fuses each step into generated kernels.
+    On a CUDA device the compiled step is also captured in CUDA graphs ('reduce-overhead'), so every step of the rollout
+    replays one graph instead of launching each kernel: the batch size and sequence length are fixed within a run.
+    The step is swapped rather than the model, so trained models still save and load as plain modules.
+    Only the step is compiled: the rollout loop goes back to python rather than compiling the unrolled sequence."""
+    global rnn_step, rnn_sequence
+    if not hasattr(torch, 'compile'):
+        print('Warning: torch.compile is not available in this version of pytorch, keeping the scripted recurrent step.')
+        return
+    mode = 'reduce-overhead' if torch.device(device).type == 'cuda' else 'default'
+    rnn_step = torch.compile(one_step, mode=mode, dynamic=False)
+    rnn_sequence = None
+
+
 class OneStepRNN(nn.Module):
 
     def __init__(self, D_in, D_out, noise_std, recurrent_size, hidden_size):
@@ -800,20 +761,37 @@ class OneStepRNN(nn.Module):
         self.recurrent_size = recurrent_size  # was 33 default to match to the parallel MLP; now larger to prevent bottleneck on context rep
         self.hidden_size = hidden_size   # was 60 default
         self.hidden_noise = noise_std
-        self.input2hidden = nn.Linear(D_in + self.recurrent_size, self.recurrent_size)
-        self.input2fc1 = nn.Linear(D_in + self.recurrent_size, self.hidden_size)  # size input, size output
+        # the input -> recurrent hidden layer and the input -> fc1 layer as one layer: outputs [:recurrent_size] are the hidden state
+        self.input2both = nn.Linear(D_in + self.recurrent_size, self.recurrent_size + self.hidden_size)  # size input, size output
         self.fc1tooutput = nn.Linear(self.hidden_size, 1)
 
+    def __setstate__(self, state):
+        # models saved before the two input layers were merged: merge their weights as they are loaded
+        super(OneStepRNN, self).__setstate__(state)
+        if 'input2hidden' in self._modules:
+            input2hidden, input2fc1 = self._modules.pop('input2hidden'), self._modules.pop('input2fc1')
+            self.input2both = nn.Linear(input2hidden.in_features, input2hidden.out_features + input2fc1.out_features).to(input2hidden.weight.device)
+            with torch.no_grad():
+                self.input2both.weight.copy_(torch.cat((input2hidden.weight, input2fc1.weight)))
+                self.input2both.bias.copy_(torch.cat((input2hidden.bias, input2fc1.bias)))
+
+    def step(self, x, hidden):
+        """One step of the network: returns (output, hidden, fc1_activations), kept as locals rather than module attributes"""
+        return rnn_step(x, hidden, self.input2both.weight, self.input2both.bias,
+            self.fc1tooutput.weight, self.fc1tooutput.bias, self.recurrent_size)
+
+    def sequence(self, x_seq, hidden):
+        """Every step of a (batch, sequenceLength, input) sequence in one scripted call: returns the stacked (outputs, hiddens)"""
+        return rnn_sequence(x_seq, hidden, self.input2both.weight, self.input2both.bias,
+            self.fc1tooutput.weight, self.fc1tooutput.bias, self.recurrent_size, float(self.hidden_noise))
+
     def forward(self, x, hidden):
-        combined = torch.cat((x, hidden), 1)
-        self.hidden = F.relu(self.input2hidden(combined))
-        self.fc1_activations = F.relu(self.input2fc1(combined))
-        self.output = torch.sigmoid(self.fc1tooutput(self.fc1_activations))
-        return self.output, self.hidden
+        output, hidden, _ = self.step(x, hidden)
+        return output, hidden
 
     def get_activations(self, x, hidden):
-        self.forward(x, hidden)  # update the activations with the particular input
-        return self.hidden, self.fc1_activations, self.output
+        output, hidden, fc1_activations = self.step(x, hidden)  # the activations for the particular input
+        return hidden, fc1_activations, output
 
     def get_noise(self):
         return self.hidden_noise
@@ -828,9 +806,6 @@ def define_hyperparams():
     If you are running this from a notebook and not the command line, just adjust the params specified in the class argparser()
     """
     args = argsparser()
-    use_cuda = False
-    device = torch.device("cuda" if use_cuda else "cpu")
-    kwargs = {'num_workers': 1, 'pin_memory': True} if use_cuda else {}
 
     command_line = True  # if running from jupyter notebook, set this to false and adjust argsparser() instead
     if command_line:
@@ -850,6 +825,7 @@ def define_hyperparams():
         parser.add_argument('--block_int_ttsplit', default="false", help='test on a different blocking/interleaving structure than training? (default: "false", train/test on same e.g. train block, test block")')
         parser.add_argument('--retrain_decoder', default="false", help='whether to retrain the final layer of a trained network, this time using VI. default: "false"')
         parser.add_argument('--train_long', default="false", help='determines if on train_short (no linking pair) or train_long (just linking pair) dataset (default: "false")')
+        parser.add_argument('--verify-dataset', dest='verify_dataset', action='store_true', default=False, help='print and check the decoded trials of a dataset sequence in view_dataset_index_info? (default: False)')
         parser.add_argument('--original_model_name', default="", help='do not adjust manually: to be used for specifying the name of old trained networks to be retrained under new conditions.')
 
         # network training hyperparameters
@@ -870,6 +846,15 @@ def define_hyperparams():
         parser.add_argument('--recurrent-size', type=int, default=200, metavar='N', help='number of nodes in recurrent layer (default: 33)')
         parser.add_argument('--hidden-size', type=int, default=200, metavar='N', help='number of nodes in hidden layer (default: 60)')
         parser.add_argument('--BPTT-len', type=int, default=120, metavar='N', help='length of sequences that we backprop through (default: 120 = whole block length)')
+        parser.add_argument('--loader-workers', type=int, default=0, metavar='N', help='number of worker processes prefetching training/test batches (default: 0, load in the main process)')
+        parser.add_argument('--resident-dataset', action='store_true', default=False, help='hold the whole train/test sets on the training device and slice batches from them, instead of using DataLoaders (default: False)')
+        parser.add_argument('--checkpoint-rollout', action='store_true', default=False, help='checkpoint the recurrent rollout in training, recomputing activations in the backward pass to save memory (default: False)')
+        parser.add_argument('--amp', action='store_true', default=False, help='run the recurrent rollout in training in bfloat16 mixed precision (default: False)')
+        parser.add_argument('--eval-interval', type=int, default=5, metavar='N', help='assess the network on the test set every N epochs (and after training); test performance is NaN on the epochs in between. The training set is only reassessed after training (default: 5)')
+        parser.add_argument('--compute-baseline', dest='compute_baseline', action='store_true', default=None, help='assess the network on the train and test sets before training (default: only when training a new model)')
+        parser.add_argument('--skip-baseline', dest='compute_baseline', action='store_false', help='do not assess the network before training; the baseline performance is recorded as NaN')
+        parser.add_argument('--log-gradients', action='store_true', default=False, help='plot the gradient flow through the network every 100 training batches (default: False)')
+        parser.add_argument('--compile', action='store_true', default=False, help='compile the recurrent step of the network with torch.compile (default: False, use the TorchScript step)')
         parser.add_argument('--noise_std', type=float, default=0.0, metavar='N', help='standard deviation of iid noise injected into the recurrent hiden state between numerical inputs (default: 0.0).')
         parser.add_argument('--model-id', type=int, default=0, metavar='N', help='for distinguishing many iterations of training same model (default: 0).')
 
@@ -878,13 +863,43 @@ def define_hyperparams():
 
     if args.which_context>0:
         args.all_fullrange = False         # cant intermingle over context ranges if you only have one context range
+    use_cuda = not args.no_cuda and torch.cuda.is_available()
+    device = torch.device("cuda" if use_cuda else "cpu")
+    if args.compile:
+        use_compiled_step(device)
     multiparams = [args.batch_size_multi, args.lr_multi]
     return args, device, multiparams
 
 
+class BackgroundWriter:
+    """Wraps a tensorboard SummaryWriter so that add_scalar only queues the scalar, and a daemon thread writes it out:
+    building the summaries and writing them to disk then stays off the training loop. close() writes out everything queued first."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._drain, daemon=True)
+        self.thread.start()
+
+    def _drain(self):
+        while True:
+            item = self.queue.get()
+            if item is None:  # closing
+                return
+            self.writer.add_scalar(*item)
+
+    def add_scalar(self, tag, value, step):
+        self.queue.put((tag, value, step))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+
+
 def log_performance(writer, epoch, train_perf, test_perf):
     """ Write out the training and testing performance for this epoch to tensorboard.
-          - 'writer' is a SummaryWriter instance
+          - 'writer' is a SummaryWriter (or BackgroundWriter) instance
     Note: -  '_standard' means its the typical way people assess training performance vs test, which I think is not a fair comparison,
           because train performance will be average performance across the epoch while network is optimising/changing, vs test which is performance
           on the optimised network over that epoch.
@@ -894,11 +909,12 @@ def log_performance(writer, epoch, train_perf, test_perf):
     test_loss, test_accuracy = test_perf
 
     writer.add_scalar('Loss/training_standard', standard_train_loss, epoch)  # inputs: tag, value, iteration
-    writer.add_scalar('Loss/training_fair', fair_train_loss, epoch)
     writer.add_scalar('Loss/testing', test_loss, epoch)
     writer.add_scalar('Accuracy/training_standard', standard_train_accuracy, epoch)
-    writer.add_scalar('Accuracy/training_fair', fair_train_accuracy, epoch)
     writer.add_scalar('Accuracy/testing', test_accuracy, epoch)
+    if fair_train_loss is not None:   # the fair training set pass is only run after the last epoch
+        writer.add_scalar('Loss/training_fair', fair_train_loss, epoch)
+        writer.add_scalar('Accuracy/training_fair', fair_train_accuracy, epoch)
 
 
 class argsparser():
@@ -952,16 +968,15 @@ def get_dataset_name(args):
 
     # create all file names
     datasetname = 'dataset'+train_state+whichcontexttext+contextlabelledtext+rangetxt + '_bpl' + str(args.BPTT_len) + '_id'+ str(args.model_id)
-    analysis_name = const.NETANALYIS_DIRECTORY +'MDSanalysis_'+networkTxt+train_state+whichcontexttext+contextlabelledtext+rangetxt+hiddenstate+'_n'+str(args.noise_std)+str_args + ttsplit + retraindecodertxt
+    analysis_name = os.path.join(const.NETANALYIS_DIRECTORY, 'MDSanalysis_'+networkTxt+train_state+whichcontexttext+contextlabelledtext+rangetxt+hiddenstate+'_n'+str(args.noise_std)+str_args + ttsplit + retraindecodertxt)
     trainingrecord_name = '_trainingrecord_'+ networkTxt + train_state+whichcontexttext+contextlabelledtext+rangetxt+hiddenstate+'_n'+str(args.noise_std)+str_args+retraindecodertxt
     if args.network_style=='recurrent':
-        trained_modelname = const.MODEL_DIRECTORY + networkTxt+'_trainedmodel'+train_state+whichcontexttext+contextlabelledtext+rangetxt+hiddenstate+'_n'+str(args.noise_std)+str_args+retraindecodertxt+'.pth'
+        trained_modelname = os.path.join(const.MODEL_DIRECTORY, networkTxt+'_trainedmodel'+train_state+whichcontexttext+contextlabelledtext+rangetxt+hiddenstate+'_n'+str(args.noise_std)+str_args+retraindecodertxt+'.pth')
     else:
-        trained_modelname = const.MODEL_DIRECTORY + networkTxt+'_trainedmodel'+train_state+whichcontexttext+contextlabelledtext+rangetxt+hiddenstate+str_args+retraindecodertxt+'.pth'
+        trained_modelname = os.path.join(const.MODEL_DIRECTORY, networkTxt+'_trainedmodel'+train_state+whichcontexttext+contextlabelledtext+rangetxt+hiddenstate+str_args+retraindecodertxt+'.pth')
     
     # if dataset exists, load this dataset instead of creating a new one
-    dataset_path = os.path.join(const.DATASET_DIRECTORY, datasetname+'.npy')
-    if os.path.exists(dataset_path):
+    if dset.dataset_exists(const.DATASET_DIRECTORY, datasetname):
         args.create_new_dataset = False
     else:
         args.create_new_dataset = True
@@ -988,11 +1003,8 @@ def train_recurrent_network(args, device, multiparams, trainset, testset):
         
         # Check if file exists to avoid overwriting
         trials_file_path = randnum + trainingrecord_name+".txt"
-        for set in ('train_', 'test_'):
-            if not os.path.exists(const.TRIALS_DIRECTORY + set + trials_file_path):
-                # create empty file
-                with open(const.TRIALS_DIRECTORY + set + trials_file_path, 'w') as file:
-                    pass
+        # keep the train/test trial record files open (and buffered) for the whole run, rather than reopening them for every write
+        trial_files = {set: open(const.TRIALS_DIRECTORY / (set + "_" + trials_file_path), 'a', buffering=1<<20) for set in ('train', 'test')}
         
         # if not os.path.exists(const.TRIALS_DIRECTORY+randnum + trainingrecord_name+".txt"):
         #     # create empty file
@@ -1003,11 +1015,11 @@ def train_recurrent_network(args, device, multiparams, trainset, testset):
         #torch.manual_seed(1)         # if we want the same default weight initialisation every time
         if args.train_long: # SN: Change this to args.train_long
             print('retraining for train_long')
-            # model = OneStepRNN(const.TOTALMAXNUM + const.NCONTEXTS + const.NTYPEBITS, 1, args.noise_std, args.recurrent_size, args.hidden_size).to(device)
+            # model = OneStepRNN(const.INPUT_WIDTH, 1, args.noise_std, args.recurrent_size, args.hidden_size).to(device)
             # for name, param in model.named_parameters():
             #     print(f"Parameter: {name}\nShape: {param.shape}\nValues:\n{param.data}\n")
             print('Loading Model: {}'.format(args.original_model_name))
-            model = torch.load(args.original_model_name)
+            model = torch.load(args.original_model_name, map_location=device)
             for name, param in model.named_parameters():
                # if 'fc1tooutput' not in name:
                 param.requires_grad = True  # (if retraining model) freeze all weights/biases except for decoder
@@ -1021,101 +1033,99 @@ def train_recurrent_network(args, device, multiparams, trainset, testset):
 
         else:
             print('Training a New Model...')
-            model = OneStepRNN(const.TOTALMAXNUM + const.NCONTEXTS + const.NTYPEBITS, 1, args.noise_std, args.recurrent_size, args.hidden_size).to(device)
+            model = OneStepRNN(const.INPUT_WIDTH, 1, args.noise_std, args.recurrent_size, args.hidden_size).to(device)
 
         # for name, param in model.named_parameters():
         #     print(f"Parameter: {name}\nShape: {param.shape}\nValues:\n{param.data}\n")
         
-        criterion = nn.BCELoss() #nn.CrossEntropyLoss()   # binary cross entropy loss
+        criterion = nn.BCEWithLogitsLoss() #nn.CrossEntropyLoss()   # binary cross entropy loss on the output logits
         optimizer = optim.SGD(model.parameters(), lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
 
         # Define our dataloaders
-        trainloader = DataLoader(trainset, batch_size=args.batch_size, shuffle=False)
-        testloader = DataLoader(testset, batch_size=args.test_batch_size, shuffle=False)
+        trainloader = dset.get_loader(trainset, args.batch_size, device, num_workers=args.loader_workers, resident=args.resident_dataset)
+        testloader = dset.get_loader(testset, args.test_batch_size, device, num_workers=args.loader_workers, resident=args.resident_dataset)
 
         # Log the model on TensorBoard and label it with the date/time and some other naming string
         now = datetime.now()
         date = now.strftime("_%d-%m-%y_%H-%M-%S")
         comment = "_batch_size-{}_lr-{}_epochs-{}_wdecay-{}".format(args.batch_size, args.lr, args.epochs, args.weight_decay)
-        writer = SummaryWriter(log_dir=const.TB_LOG_DIRECTORY + trainingrecord_name + args.modeltype + date + comment)
+        writer = BackgroundWriter(SummaryWriter(log_dir=os.path.join(const.TB_LOG_DIRECTORY, trainingrecord_name + args.modeltype + date + comment)))
         print("Open tensorboard in another shell to monitor network training (hannahsheahan$  tensorboard --logdir=runs)")
 
         # Train/test loop
         n_epochs = args.epochs
         printOutput = False
-        trainingPerformance, testPerformance = [[] for i in range(2)]
+        # the performance after every epoch (the baseline at 0), preallocated and doubled if training short runs past n_epochs.
+        # epochs the network is not assessed on stay NaN
+        trainingPerformance, testPerformance = [np.full(n_epochs + 1, np.nan, dtype=np.float32) for i in range(2)]
 
         print("Training network...")
         
         # for the text file to seperate the trials when recurrent_test is called between testing the trainloader or testloader sets
         testing_set = 'train' # set as either 'train' or 'test' to indicate which set is being tested (trainloader or testloader respectively)
 
-        # Take baseline performance measures
-        optimizer.zero_grad()
-        _, base_train_accuracy = recurrent_test(args, model, device, trainloader, criterion, trials_file_path, testing_set, printOutput)
-        testing_set = 'test'
-        _, base_test_accuracy = recurrent_test(args, model, device, testloader, criterion, trials_file_path, testing_set, printOutput)
-        print('Baseline train: {:.2f}%, Baseline test: {:.2f}%'.format(base_train_accuracy, base_test_accuracy))
-        trainingPerformance.append(base_train_accuracy)
-        testPerformance.append(base_test_accuracy)
+        # Take baseline performance measures (two passes over the data: by default skipped when retraining a loaded model)
+        compute_baseline = args.compute_baseline if args.compute_baseline is not None else not (args.train_long or args.retrain_decoder)
+        optimizer.zero_grad(set_to_none=True)
+        if compute_baseline:
+            _, base_train_accuracy = recurrent_test(args, model, device, trainloader, criterion, trials_file_path, testing_set, printOutput, trial_files)
+            testing_set = 'test'
+            _, base_test_accuracy = recurrent_test(args, model, device, testloader, criterion, trials_file_path, testing_set, printOutput, trial_files)
+            print('Baseline train: {:.2f}%, Baseline test: {:.2f}%'.format(base_train_accuracy, base_test_accuracy))
+        else:
+            base_train_accuracy = base_test_accuracy = float('nan')
+        trainingPerformance[0] = base_train_accuracy
+        testPerformance[0] = base_test_accuracy
         print_progress(0, n_epochs)
 
-        standard_train_accuracy = 0.0
-        epoch = 0
-        #SN:  if statement here with args.train_long. 20 trials of train long
-        if args.train_long == False: # train short up to 90 percent accuracy
-            with open(const.TRIALS_DIRECTORY+"train_"+trials_file_path, 'a') as file:
-                file.write('\nTraining short...')
-            with open(const.TRIALS_DIRECTORY+"test_"+trials_file_path, 'a') as file:
-                file.write('\nTraining short...')
-            while standard_train_accuracy < 90.0: # trains until the network is performing well on the training set
-
-                # train network
-                standard_train_loss, standard_train_accuracy = recurrent_train(args, model, device, trainloader, optimizer, criterion, epoch, printOutput)
-
-                # assess network
-                testing_set = 'train'
-                fair_train_loss, fair_train_accuracy = recurrent_test(args, model, device, trainloader, criterion, trials_file_path, testing_set, printOutput)
-                testing_set = 'test'
-                test_loss, test_accuracy = recurrent_test(args, model, device, testloader, criterion, trials_file_path, testing_set, printOutput)
+        def run_epoch(epoch, stop_accuracy=None):
+            """Train the network for one epoch, then assess it on the test set every args.eval_interval epochs and after the last
+            epoch (the last of n_epochs, or the one reaching stop_accuracy). The fair (end of epoch) pass over the whole training
+            set is only run after the last epoch. Returns the running training accuracy over the epoch."""
+            nonlocal trainingPerformance, testPerformance
+            standard_train_loss, standard_train_accuracy = recurrent_train(args, model, device, trainloader, optimizer, criterion, epoch, printOutput)
+            if epoch >= len(trainingPerformance):
+                trainingPerformance, testPerformance = [np.concatenate((record, np.full(len(record), np.nan, dtype=np.float32))) for record in (trainingPerformance, testPerformance)]
+            trainingPerformance[epoch] = standard_train_accuracy
+            last_epoch = (epoch == n_epochs) if stop_accuracy is None else (standard_train_accuracy >= stop_accuracy)
+            if epoch % args.eval_interval == 0 or last_epoch:
+                fair_train_loss, fair_train_accuracy = None, None
+                if last_epoch:
+                    fair_train_loss, fair_train_accuracy = recurrent_test(args, model, device, trainloader, criterion, trials_file_path, 'train', printOutput, trial_files)
+                test_loss, test_accuracy = recurrent_test(args, model, device, testloader, criterion, trials_file_path, 'test', printOutput, trial_files)
 
                 # log performance
                 train_perf = [standard_train_loss, standard_train_accuracy, fair_train_loss, fair_train_accuracy]
                 test_perf = [test_loss, test_accuracy]
-                trainingPerformance.append(standard_train_accuracy)
-                testPerformance.append(test_accuracy)
+                testPerformance[epoch] = test_accuracy
                 print('Train: {:.2f}%, Test: {:.2f}%'.format(standard_train_accuracy, test_accuracy))
-                epoch += 1
                 log_performance(writer, epoch, train_perf, test_perf)
-                print_progress(epoch, n_epochs)
+            else:   # not assessed this epoch
+                print('Train: {:.2f}%'.format(standard_train_accuracy))
+            print_progress(epoch, n_epochs)
+            for file in trial_files.values():
+                file.flush()   # write out this epoch's trial records
+            return standard_train_accuracy
+
+        standard_train_accuracy = 0.0
+        epoch = 0
+        #SN:  if statement here with args.train_long. 20 trials of train long
+        if args.train_long == False: # train short up to 90 percent accuracy
+            trial_files['train'].write('\nTraining short...')
+            trial_files['test'].write('\nTraining short...')
+            while standard_train_accuracy < 90.0: # trains until the network is performing well on the training set
+                epoch += 1
+                standard_train_accuracy = run_epoch(epoch, stop_accuracy=90.0)
         else: # train long for n epochs
-            with open(const.TRIALS_DIRECTORY+"train_"+trials_file_path, 'a') as file:
-                file.write('\nTraining long...')
-            with open(const.TRIALS_DIRECTORY+"test_"+trials_file_path, 'a') as file:
-                file.write('\nTraining long...')
+            trial_files['train'].write('\nTraining long...')
+            trial_files['test'].write('\nTraining long...')
             for epoch in range(1, n_epochs + 1):
-                with open(const.TRIALS_DIRECTORY+"train_"+trials_file_path, 'a') as file:
-                    file.write('\nEpoch {}\n'.format(epoch))
-                with open(const.TRIALS_DIRECTORY+"test_"+trials_file_path, 'a') as file:
-                    file.write('\nEpoch {}\n'.format(epoch))
-                # train network
-                standard_train_loss, standard_train_accuracy = recurrent_train(args, model, device, trainloader, optimizer, criterion, epoch, printOutput)
-
-                # assess network
-                testing_set = 'train'
-                fair_train_loss, fair_train_accuracy = recurrent_test(args, model, device, trainloader, criterion, trials_file_path, testing_set, printOutput)
-                testing_set = 'test'
-                test_loss, test_accuracy = recurrent_test(args, model, device, testloader, criterion, trials_file_path, testing_set, printOutput)
+                trial_files['train'].write('\nEpoch {}\n'.format(epoch))
+                trial_files['test'].write('\nEpoch {}\n'.format(epoch))
+                run_epoch(epoch)
+        for file in trial_files.values():
+            file.close()
 
-                # log performance
-                train_perf = [standard_train_loss, standard_train_accuracy, fair_train_loss, fair_train_accuracy]
-                test_perf = [test_loss, test_accuracy]
-                trainingPerformance.append(standard_train_accuracy)
-                testPerformance.append(test_accuracy)
-                print('Train: {:.2f}%, Test: {:.2f}%'.format(standard_train_accuracy, test_accuracy))
-                log_performance(writer, epoch, train_perf, test_perf)
-                print_progress(epoch, n_epochs)
-        
         '''  # this is the trainig loop that trained for a set number of epochs
         # for epoch in range(1, n_epochs + 1):  # loop through the whole dataset this many times
 
@@ -1137,16 +1147,13 @@ def train_recurrent_network(args, device, multiparams, trainset, testset):
         '''
 
         print("Training complete.")
-        # save this training curve
-        record = {"trainingPerformance":trainingPerformance, "testPerformance":testPerformance, "args":vars(args) }
-        
-        dat = json.dumps(record)
-        f = open(const.TRAININGRECORDS_DIRECTORY+randnum + trainingrecord_name+".json","w")
-        f.write(dat)
-        
-        f.close()
+        # save this training curve (as compressed numpy arrays, with the args kept as a json string)
+        np.savez_compressed(const.TRAININGRECORDS_DIRECTORY / (randnum + trainingrecord_name+".npz"),
+            trainingPerformance=trainingPerformance[:epoch+1],
+            testPerformance=testPerformance[:epoch+1],
+            args=json.dumps(vars(args)))
+        writer.close()  # flush this run's queued scalars and stop its thread before the next run starts its own
 
-    writer.close()
     return model
 
 
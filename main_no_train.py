@@ -42,6 +42,7 @@ if __name__ == '__main__':
     args.block_int_ttsplit = False  # True: test on a different distribution (block/interleave) than training
     args.retrain_decoder = False
     args.model_id = 20          
+    args.verify_dataset = True      # this script is for inspecting the datasets, so always print the dataset checks
     #args.model_id = 9999          # for visualising or analysing a particular trained model
 
     # Grab the future/current model names for short and long
@@ -21,7 +21,6 @@ from mpl_toolkits import mplot3d
 import math
 import numpy as np
 import scipy as sp
-import copy
 import sys
 import random
 import os
@@ -352,7 +351,7 @@ def plot_3mds_mean(MDS_dict, args, labelNumerosity=True, plot_diff_code=False, w
                 contextC = range(const.HIGHR_LLIM-1, const.HIGHR_ULIM)#range(const.FULLR_SPAN+const.LOWR_SPAN, const.FULLR_SPAN+const.LOWR_SPAN+const.HIGHR_SPAN)
 
             # Rotate the components on the 2d plot since global orientation doesnt matter (axes are arbitrary)
-            rotated_act = copy.deepcopy(MDS_act)
+            rotated_act = MDS_act.copy()
             # print('MDS_act', MDS_act)
             print('MDS_act.shape', MDS_act.shape)
             # print('MDS_act.flatten', MDS_act.flatten())
@@ -497,7 +496,7 @@ def animate_3d_mds(MDS_dict, args, plot_diff_code=False, whichTrialType='compare
             train_set = 'trainshort_'
         Writer = animation.writers['ffmpeg']
         writer = Writer(fps=30, metadata=dict(artist='Me'), bitrate=1800)
-        strng = save_figure(const.ANIMATION_DIRECTORY + 'MDS_3Danimation_'+ train_set+differenceCodeText, args, True,  plot_diff_code, whichTrialType, False)
+        strng = save_figure(os.path.join(const.ANIMATION_DIRECTORY, 'MDS_3Danimation_'+ train_set+differenceCodeText), args, True,  plot_diff_code, whichTrialType, False)
         anim.save(strng+'.mp4', writer=writer)
 
 
@@ -614,7 +613,7 @@ def animate_3d_drift_mds(MDS_dict, args, whichTrialType='compare', saveFig=True)
     if saveFig:
         Writer = animation.writers['ffmpeg']
         writer = Writer(fps=30, metadata=dict(artist='Me'), bitrate=1800)
-        strng = save_figure(const.ANIMATION_DIRECTORY + 'latentdrift_MDS_3Danimation_', True, False, whichTrialType, False)
+        strng = save_figure(os.path.join(const.ANIMATION_DIRECTORY, 'latentdrift_MDS_3Danimation_'), True, False, whichTrialType, False)
         anim.save(strng+'.mp4', writer=writer)
 
 
@@ -697,7 +696,7 @@ def compare_lesion_tests(args, device):
             print('modelid: ' + str(args.model_id))
             testParams = anh.setup_test_parameters(args, device)
             block_ttsplit_text = '_blockttsplit' if args.block_int_ttsplit else ''
-            basefilename = const.LESIONS_DIRECTORY + 'lesiontests'+m[:-4] + block_ttsplit_text
+            basefilename = os.path.join(const.LESIONS_DIRECTORY, 'lesiontests'+m[:-4] + block_ttsplit_text)
             filename = basefilename+'.npy'
 
             # perform or load the lesion tests
@@ -811,7 +810,7 @@ def perf_vs_context_distance(args, device):
             args.model_id = anh.get_id_from_name(m)
             testParams = anh.setup_test_parameters(args, device)
             block_ttsplit_text = '_blockttsplit' if args.block_int_ttsplit else ''
-            basefilename = const.LESIONS_DIRECTORY + 'lesiontests'+m[:-4] + block_ttsplit_text
+            basefilename = os.path.join(const.LESIONS_DIRECTORY, 'lesiontests'+m[:-4] + block_ttsplit_text)
             filename = basefilename+'.npy'
 
             # perform or load the lesion tests
@@ -971,7 +970,7 @@ def view_postlesion(args, device):
     full_context_perf, low_context_perf, high_context_perf = [[] for i in range(3)]
 
     testParams = anh.setup_test_parameters(args, device)
-    basefilename = const.LESIONS_DIRECTORY + 'lesiontests'+m[0][:-4]
+    basefilename = os.path.join(const.LESIONS_DIRECTORY, 'lesiontests'+m[0][:-4])
     filename = basefilename+'.npy'
 
     # perform or load the lesion tests
@@ -1087,9 +1086,9 @@ def generate_plots(MDS_dict, args):
         #animate_3d_mds(MDS_dict, args, plot_diff_code)  # plot a 3D version of the MDS constructions
 
 def dataset_range_heatmap(datasetname, args):
-    x = np.load(const.DATASET_DIRECTORY+datasetname+'.npy', allow_pickle=True)
-    numpy_trainset = x.item().get('trainset')
-    numpy_testset = x.item().get('testset')
+    data = dset.read_input_data(const.DATASET_DIRECTORY, datasetname)  # memory-mapped, no unpickling
+    numpy_trainset = data['trainset']
+    numpy_testset = data['testset']
     
     if args.train_long:
         train_set = 'long_'
@@ -1108,7 +1107,8 @@ def dataset_range_heatmap(datasetname, args):
     
 def dataset_histogram(datasetname, args):
     datasetname, __, _, _ = mnet.get_dataset_name(args)
-    __, __, __, numpy_trainset, numpy_testset, __ = dset.load_input_data(const.DATASET_DIRECTORY, datasetname)
+    data = dset.read_input_data(const.DATASET_DIRECTORY, datasetname)
+    numpy_trainset, numpy_testset = data['trainset'], data['testset']
     
     if args.train_long:
         train_set = 'long_'
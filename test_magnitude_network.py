@@ -0,0 +1,95 @@
+"""
+Tests for the network analysis helpers in magnitude_network.py, on a small generated dataset and an untrained network.
+Run with: python -m pytest test_magnitude_network.py
+"""
+
+import define_dataset as dset
+import magnitude_network as mnet
+import constants as const
+import numpy as np
+import torch
+from itertools import repeat
+
+
+class TinyArgs:
+    """Just the settings that generate_block and get_activations read"""
+    def __init__(self, retain_hidden_state=False):
+        self.BPTT_len = 30
+        self.all_fullrange = False
+        self.include_fillers = True
+        self.label_context = 'true'
+        self.train_long = False
+        self.which_context = 0
+        self.network_style = 'recurrent'
+        self.retain_hidden_state = retain_hidden_state
+
+
+def tiny_trainset(args, Mblocks=3, N=6, seed=0):
+    """A few generated sequences, assembled the way create_separate_input_data assembles them"""
+    seeds = np.random.default_rng(seed).integers(np.iinfo(np.int64).max, size=Mblocks)
+    blockdata = [dset.generate_block(block, 'train', Mblocks, N, args, blockseed) for block, blockseed in zip(range(Mblocks), seeds)]
+    blockarrays = {key: np.stack([data[key] for data in blockdata]) for key in dset.BLOCK_FIELDS}
+    return dset.finalize_phase_data(blockarrays, np.arange(N).reshape((Mblocks, N // Mblocks, 1)))
+
+
+def tiny_model(seed=0):
+    torch.manual_seed(seed)
+    return mnet.OneStepRNN(const.INPUT_WIDTH, 1, 0.0, 12, 10)
+
+
+def test_get_activations_reset_state():
+    # the non-retained recurrent branch runs, and gives one row of fc1 activations per unique (input, previous input, context)
+    args = TinyArgs()
+    trainset = tiny_trainset(args)
+    model = tiny_model()
+    activations, MDSlabels, labels_refValues, labels_judgeValues, contexts, time_index, counter, drift, trialtypes = mnet.get_activations(args, trainset, model, None)
+    _, rows = mnet.format_input_sequence(const.TRIAL_COMPARE, trainset)
+    assert activations.shape == (len(np.unique(rows, axis=0)), model.hidden_size)
+    assert np.all(np.isfinite(activations))
+
+
+def per_sample_activations(model, trainset):
+    """The reset-state activations computed as get_activations did before it was batched: each unique pair on its own,
+    from a zero hidden state, returned sorted the way get_activations sorts them"""
+    seq_record, rows = mnet.format_input_sequence(const.TRIAL_COMPARE, trainset)
+    firstOccurrence = {}
+    for i, row in enumerate(rows):
+        firstOccurrence.setdefault(row.tobytes(), i)
+    uniqueind = np.fromiter(firstOccurrence.values(), dtype=np.int64)
+    activations = np.empty((len(uniqueind), model.hidden_size))
+    with torch.inference_mode():
+        for sample, row in enumerate(rows[uniqueind]):
+            context = np.append(row[2*const.TOTALMAXNUM:], float(const.TRIAL_COMPARE))
+            recurrentinputs = [torch.from_numpy(np.concatenate((number, context)).astype(np.float32)).unsqueeze(0) for number in (row[:const.TOTALMAXNUM], row[const.TOTALMAXNUM:2*const.TOTALMAXNUM])]
+            hidden = torch.zeros(1, model.recurrent_size)
+            for i in range(2):
+                hidden, h1activations, _ = model.get_activations(recurrentinputs[i], hidden)
+            activations[sample] = h1activations[0].numpy()
+    labels, contextdigits, refdigits, judgementdigits = mnet.flatten_lists_to_arrays(trainset, seq_record[uniqueind,0], seq_record[uniqueind,1], ["label", "contextdigits", "refdigits", "judgementdigits"])
+    blank = np.zeros((len(uniqueind),1))
+    allvars = [contextdigits[:,None].astype(float), activations, labels.reshape(-1,1).astype(float), refdigits[:,None].astype(float), judgementdigits[:,None].astype(float), blank, blank.copy()]
+    return mnet.sort_activations(allvars)[1]
+
+
+def test_get_activations_batched_matches_per_sample():
+    # the single batched pass over the unique pairs gives the activations of running each pair through the network on its own
+    args = TinyArgs()
+    trainset = tiny_trainset(args, seed=1)
+    model = tiny_model(seed=1)
+    activations = mnet.get_activations(args, trainset, model, None)[0]
+    np.testing.assert_allclose(activations, per_sample_activations(model, trainset), rtol=1e-5, atol=1e-6)
+
+
+def test_get_activations_shared_first_steps():
+    # unique pairs that share their first input and context start their second step from one shared hidden state,
+    # which must match running each pair from a zero hidden state
+    args = TinyArgs()
+    args.BPTT_len = 60
+    trainset = tiny_trainset(args, seed=2)
+    _, rows = mnet.format_input_sequence(const.TRIAL_COMPARE, trainset)
+    pairs = np.unique(rows, axis=0)
+    firstinputs = np.unique(np.concatenate((pairs[:, :const.TOTALMAXNUM], pairs[:, 2*const.TOTALMAXNUM:]), 1), axis=0)
+    assert len(firstinputs) < len(pairs)   # so some first steps are shared
+    model = tiny_model(seed=2)
+    activations = mnet.get_activations(args, trainset, model, None)[0]
+    np.testing.assert_allclose(activations, per_sample_activations(model, trainset), rtol=1e-5, atol=1e-6)